@@ -0,0 +1,199 @@
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+
+class AudioOptions(NamedTuple):
+    """How clips are compacted before being added to a deck."""
+
+    enabled: bool = False
+    bitrate: int = 32  # kbit/s, plenty for a single voice
+    silence_db: int = -50  # Leading and trailing audio below this is trimmed
+
+    @classmethod
+    def from_env(cls) -> "AudioOptions":
+        """Options from LCG_AUDIO_COMPACT, LCG_AUDIO_BITRATE and LCG_AUDIO_SILENCE_DB."""
+        default = cls()
+        return cls(
+            os.environ.get("LCG_AUDIO_COMPACT", "0").lower() in ("1", "true", "yes"),
+            int(os.environ.get("LCG_AUDIO_BITRATE", default.bitrate)),
+            int(os.environ.get("LCG_AUDIO_SILENCE_DB", default.silence_db)),
+        )
+
+    def filename(self, clip_key: str) -> str:
+        """Media filename of the compacted version of the clip ``clip_key``."""
+        raw = "\x1f".join([clip_key, str(self.bitrate), str(self.silence_db)])
+        return f"sound_{hashlib.sha256(raw.encode('utf-8')).hexdigest()[:16]}.mp3"
+
+
+def ffmpeg_available() -> bool:
+    return shutil.which(os.environ.get("LCG_FFMPEG", "ffmpeg")) is not None
+
+
+def compact_clip(data: bytes, options: AudioOptions = AudioOptions()) -> bytes | None:
+    """
+    Trim the silence around a clip, downmix it to mono and re-encode it as mp3.
+
+    None is returned if ffmpeg fails or the result is not smaller, in which
+    case the original clip, in its own format, should be kept.
+    """
+    # silenceremove only trims the start, so the end is trimmed on the reversed clip
+    trim = (
+        f"silenceremove=start_periods=1:start_threshold={options.silence_db}dB"
+        ":start_silence=0.05"
+    )
+    command = [
+        os.environ.get("LCG_FFMPEG", "ffmpeg"),
+        "-hide_banner",
+        "-loglevel",
+        "error",
+        "-i",
+        "pipe:0",
+        "-af",
+        f"{trim},areverse,{trim},areverse",
+        "-ac",
+        "1",
+        "-b:a",
+        f"{options.bitrate}k",
+        "-f",
+        "mp3",
+        "pipe:1",
+    ]
+    try:
+        result = subprocess.run(command, input=data, capture_output=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    if not result.stdout or len(result.stdout) >= len(data):
+        return None
+    return result.stdout
+
+
+def compact_clips(
+    clips: list[bytes],
+    options: AudioOptions = AudioOptions(),
+    workers: int | None = None,
+) -> list[bytes | None]:
+    """
+    Compact many clips, one ffmpeg process per clip and per CPU core at most.
+
+    Args:
+        clips (list[bytes]): The encoded clips
+        options (AudioOptions): The processing options
+        workers (int): Number of concurrent ffmpeg processes, defaults to the
+            CPU count
+
+    Returns:
+        list[bytes | None]: The compacted clips, in the same order, None
+            for the clips compact_clip could not make smaller
+    """
+    if len(clips) < 2 or workers == 1:
+        return [compact_clip(data, options) for data in clips]
+    # ffmpeg does the work in its own process, so threads are enough to use all cores
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        return list(executor.map(compact_clip, clips, [options] * len(clips)))
+
+
+SILENCE_START = re.compile(r"silence_start: (-?[\d.]+)")
+SILENCE_END = re.compile(r"silence_end: ([\d.]+)")
+
+
+def detect_silences(
+    data: bytes, silence_db: int = -45, min_silence: float = 0.25
+) -> tuple[list[tuple[float, float]], float]:
+    """
+    Find the silences of a clip with ffmpeg's silencedetect filter.
+
+    Returns:
+        tuple[list[tuple[float, float]], float]: The (start, end) of every
+        silence of at least ``min_silence`` seconds, and the clip duration
+    """
+    # Decoding to raw 16 kHz mono samples gives the exact duration as well
+    command = [
+        os.environ.get("LCG_FFMPEG", "ffmpeg"),
+        "-hide_banner",
+        "-nostats",
+        "-i",
+        "pipe:0",
+        "-af",
+        f"silencedetect=noise={silence_db}dB:duration={min_silence}",
+        "-ac",
+        "1",
+        "-ar",
+        "16000",
+        "-f",
+        "s16le",
+        "pipe:1",
+    ]
+    result = subprocess.run(command, input=data, capture_output=True, check=True)
+    duration = len(result.stdout) / 32000
+    log = result.stderr.decode("utf-8", "replace")
+    starts = [max(0.0, float(t)) for t in SILENCE_START.findall(log)]
+    ends = [float(t) for t in SILENCE_END.findall(log)]
+    ends += [duration] * (len(starts) - len(ends))  # Silent until the end
+    return list(zip(starts, ends)), duration
+
+
+def split_clip(
+    data: bytes, cut_points: list[float], extension: str = "mp3"
+) -> list[bytes]:
+    """Cut a clip at the given times (in seconds), without re-encoding it."""
+    with tempfile.TemporaryDirectory(prefix="lcg_split_") as directory:
+        command = [
+            os.environ.get("LCG_FFMPEG", "ffmpeg"),
+            "-hide_banner",
+            "-loglevel",
+            "error",
+            "-i",
+            "pipe:0",
+            "-c",
+            "copy",
+            "-f",
+            "segment",
+            "-segment_times",
+            ",".join(f"{t:.3f}" for t in cut_points),
+            "-reset_timestamps",
+            "1",
+            os.path.join(directory, f"%04d.{extension}"),
+        ]
+        subprocess.run(command, input=data, capture_output=True, check=True)
+        clips = []
+        for filename in sorted(os.listdir(directory)):
+            with open(os.path.join(directory, filename), "rb") as f:
+                clips.append(f.read())
+        return clips
+
+
+def split_on_silences(
+    data: bytes, count: int, silence_db: int = -45, min_silence: float = 0.25
+) -> list[bytes] | None:
+    """
+    Split a clip of ``count`` utterances separated by pauses into one clip each.
+
+    Each cut is in the middle of a pause. Returns None unless exactly
+    ``count - 1`` pauses are found between the utterances, since the clips
+    could not be matched to them otherwise, or if ffmpeg fails.
+    """
+    try:
+        silences, duration = detect_silences(data, silence_db, min_silence)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    # Only the pauses between utterances, not the silence at either end
+    gaps = [
+        (start, end)
+        for start, end in silences
+        if start > 0.01 and end < duration - 0.01
+    ]
+    if len(gaps) != count - 1:
+        return None
+    try:
+        clips = split_clip(data, [(start + end) / 2 for start, end in gaps])
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    if len(clips) != count or not all(clips):
+        return None
+    return clips
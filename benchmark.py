@@ -0,0 +1,277 @@
+"""
+Offline benchmarks of the deck building pipeline.
+
+gTTS and all HTTP traffic are replaced by deterministic local fakes with a
+configurable latency and payload size, so runs are repeatable and free. Each
+stage is timed and its peak Python memory measured with tracemalloc, which
+adds some overhead of its own. Results are written as JSON and can be compared
+with an earlier run.
+
+Example:
+    python benchmark.py --sizes 10 1000 --output before.json
+    python benchmark.py --sizes 10 1000 --output after.json --compare before.json
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from contextlib import ExitStack, contextmanager
+from datetime import datetime, timezone
+from unittest import mock
+
+from PIL import Image
+
+import images
+import ratelimit
+import tts
+from deck_builder import MODES, DeckBuilder, create_list_of_cards
+
+
+def synthetic_text(mode: str, n: int) -> str:
+    """Deterministic input of ``n`` distinct cards for a mode."""
+    if mode == "lexicon":
+        lines = (
+            f"wort{i} | word {i} | das Wort{i}, -e | Das ist Satz {i}. | "
+            f"This is sentence {i}. | Noch ein Satz {i}. | Another sentence {i}."
+            for i in range(n)
+        )
+    elif mode == "pronunciation":
+        lines = (f"Aussprache {i}" for i in range(n))
+    else:
+        lines = (
+            f"Ich gehe {i} | Ich ging {i} | Präteritum Regel {i}" for i in range(n)
+        )
+    return "\n".join(lines)
+
+
+def fake_clip(text: str, size: int) -> bytes:
+    """Deterministic pseudo-mp3 payload of ``size`` bytes for a text."""
+    seed = hashlib.sha256(text.encode("utf-8")).digest()
+    return (seed * (size // len(seed) + 1))[:size]
+
+
+def fake_png(size: int) -> bytes:
+    """A PNG of roughly ``size`` bytes, made of incompressible noise."""
+    side = max(8, int((size / 3) ** 0.5))
+    img = Image.frombytes("RGB", (side, side), fake_clip("image", side * side * 3))
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class FakeResponse:
+    def __init__(self, text="", content=b"", status_code=200):
+        self.text = text
+        self.content = content
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeSession:
+    """Stands in for the shared requests.Session used by images.py."""
+
+    def __init__(self, latency: float, image: bytes, results_per_search: int = 20):
+        self.latency = latency
+        self.image = image
+        self.search_page = "<html><body>" + "".join(
+            f'<div><img src="https://images.invalid/{i}.png"></div>'
+            for i in range(results_per_search + 1)
+        )
+
+    def get(self, url, params=None, timeout=None):
+        time.sleep(self.latency)
+        if params is not None:  # Image search
+            return FakeResponse(text=self.search_page)
+        return FakeResponse(content=self.image)
+
+
+@contextmanager
+def offline(tts_latency: float, clip_bytes: int, http_latency: float, image_bytes):
+    """Replace gTTS, the audio cache and HTTP with local fakes."""
+
+    def fake_gtts(request):
+        time.sleep(tts_latency)
+        return fake_clip(request.text, clip_bytes)
+
+    session = FakeSession(http_latency, fake_png(image_bytes))
+    with ExitStack() as stack:
+        stack.enter_context(mock.patch.object(tts, "_gtts_bytes", fake_gtts))
+        stack.enter_context(mock.patch.object(tts, "get_audio_cache", lambda: None))
+        stack.enter_context(mock.patch.object(images, "get_session", lambda: session))
+        # The fakes can take any rate, so the shared limiter is lifted
+        unlimited = ratelimit.RateLimiter("offline", 1e9, burst=10**9)
+        stack.enter_context(
+            mock.patch.object(images, "get_limiter", lambda name: unlimited)
+        )
+        yield
+
+
+def measure(stage: str, mode: str, cards: int, items: int, func):
+    """Run ``func`` once and return its result and a benchmark record."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = func()
+        seconds = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    record = {
+        "stage": stage,
+        "mode": mode,
+        "cards": cards,
+        "items": items,
+        "seconds": round(seconds, 6),
+        "items_per_second": round(items / seconds, 1) if seconds else None,
+        "peak_memory_bytes": peak,
+    }
+    print(
+        f"{mode:>13} {cards:>6} {stage:<14} {seconds:>9.3f}s "
+        f"{record['items_per_second'] or 0:>12.1f}/s {peak / 1e6:>9.1f} MB"
+    )
+    return result, record
+
+
+def run_mode(mode: str, n: int, args) -> list[dict]:
+    records = []
+    text = synthetic_text(mode, n)
+
+    cards, record = measure(
+        "parse",
+        mode,
+        n,
+        len(text.splitlines()),
+        lambda: create_list_of_cards(text, mode),
+    )
+    records.append(record)
+
+    builder = DeckBuilder("de", mode, tts_backend=tts.get_backend("gtts"))
+    try:
+        if mode == "lexicon":
+            # Start from a cold search cache for every size
+            images._search_cache = images.TTLCache(images._search_cache.ttl)
+            # Image search and download for the first cards, two images each
+            n_images = min(n, args.max_image_cards)
+            urls, record = measure(
+                "image_search",
+                mode,
+                n,
+                n_images,
+                lambda: [
+                    images.get_image_urls(card["baseT"], "de")
+                    for card in cards[:n_images]
+                ],
+            )
+            records.append(record)
+            downloaded, record = measure(
+                "image_download",
+                mode,
+                n,
+                2 * n_images,
+                lambda: [images.load_images(card_urls[:2])[0] for card_urls in urls],
+            )
+            records.append(record)
+            card_images = downloaded + [[] for _ in range(n - n_images)]
+        else:
+            card_images = None
+
+        _, record = measure(
+            "notes",
+            mode,
+            n,
+            n,
+            lambda: builder.add_cards(
+                cards, images=card_images, max_workers=args.workers
+            ),
+        )
+        records.append(record)
+
+        output = io.BytesIO()
+        _, record = measure(
+            "package", mode, n, n, lambda: builder.write_to_file(output)
+        )
+        record["package_bytes"] = output.getbuffer().nbytes
+        records.append(record)
+    finally:
+        builder.close()
+    return records
+
+
+def compare(results: list[dict], baseline_path: str):
+    """Print the time ratio of each stage against a previous run."""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {
+            (r["mode"], r["cards"], r["stage"]): r for r in json.load(f)["results"]
+        }
+    print(f"\nCompared with {baseline_path} (time ratio, <1 is faster):")
+    for r in results:
+        old = baseline.get((r["mode"], r["cards"], r["stage"]))
+        if old and old["seconds"]:
+            ratio = r["seconds"] / old["seconds"]
+            print(f"{r['mode']:>13} {r['cards']:>6} {r['stage']:<14} {ratio:>6.2f}x")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES)
+    parser.add_argument("--sizes", nargs="+", type=int, default=[10, 1000, 50000])
+    parser.add_argument(
+        "--tts-latency", type=float, default=0.0, help="Seconds per fake TTS call"
+    )
+    parser.add_argument(
+        "--clip-bytes", type=int, default=4096, help="Size of each fake clip"
+    )
+    parser.add_argument(
+        "--http-latency", type=float, default=0.0, help="Seconds per fake request"
+    )
+    parser.add_argument(
+        "--image-bytes", type=int, default=50_000, help="Size of the fake image"
+    )
+    parser.add_argument(
+        "--max-image-cards",
+        type=int,
+        default=200,
+        help="Lexicon cards that get images, to keep large runs reasonable",
+    )
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("-o", "--output", default="benchmark_results.json")
+    parser.add_argument("--compare", help="Previous results file to compare with")
+    args = parser.parse_args(argv)
+
+    results = []
+    with offline(
+        args.tts_latency, args.clip_bytes, args.http_latency, args.image_bytes
+    ):
+        for mode in args.modes:
+            for n in args.sizes:
+                results.extend(run_mode(mode, n, args))
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "meta": {
+                    "created": datetime.now(timezone.utc).isoformat(),
+                    "python": sys.version.split()[0],
+                    "platform": platform.platform(),
+                    "config": vars(args),
+                },
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""
+Build Anki decks from text files without the Streamlit UI.
+
+Example:
+    python cli.py words.txt verbs.txt --language de --mode pronunciation -o decks/
+"""
+
+import argparse
+import itertools
+import os
+import sys
+import time
+
+from audio import AudioOptions
+from deck_builder import MODES, DeckBuilder
+from deck_store import get_deck_store
+from metrics import NULL_METRICS, Metrics
+from parsing import FORMATS, ParseReport, iter_cards_from_file
+from tts import BACKENDS, GTTSBackend, get_backend
+
+
+def build_deck(
+    path,
+    language,
+    mode,
+    output_dir,
+    workers=None,
+    deck_name=None,
+    fmt=None,
+    strict=False,
+    chunk_size=1000,
+    metrics=NULL_METRICS,
+    tts_backend=None,
+    compact_audio=False,
+    append=False,
+    delta=False,
+    join_speech=False,
+):
+    """
+    Build one .apkg from an input file and return the path of the package.
+
+    With ``append`` the deck is recorded as exported, and with ``delta`` the
+    cards added since its previous export are also written to <stem>.delta.apkg.
+    """
+    # Validate the whole file first, so bad rows are reported before any TTS
+    report = ParseReport()
+    with metrics.stage("parse"):
+        for _ in iter_cards_from_file(path, mode, fmt, report):
+            pass
+    metrics.add_items("parse", report.accepted)
+    for line in report.lines():
+        print(f"  {path}: {line}", file=sys.stderr)
+    if strict and not report.ok:
+        raise ValueError(f"{report.rejected_count} rows rejected")
+
+    backend = get_backend(tts_backend)
+    if join_speech and backend.name == "gtts":
+        backend = GTTSBackend(join=True)
+    builder = DeckBuilder(
+        language,
+        mode,
+        deck_name=deck_name,
+        metrics=metrics,
+        tts_backend=backend,
+        audio_options=(
+            AudioOptions.from_env()._replace(enabled=True) if compact_audio else None
+        ),
+        store=get_deck_store() if append else None,
+    )
+    try:
+        # Stream the cards in chunks to keep memory bounded on large inputs
+        cards = iter_cards_from_file(path, mode, fmt)
+        while chunk := list(itertools.islice(cards, chunk_size)):
+            builder.add_cards(chunk, max_workers=workers)
+        stem = os.path.splitext(os.path.basename(path))[0]
+        output_path = os.path.join(output_dir, f"{stem}.apkg")
+        builder.write_to_file(output_path)
+        print(f"{path}: {report.summary()} -> {output_path}")
+        if append:
+            since = builder.last_checkpoint
+            new_cards = len(builder.notes_since(since)) if since is not None else 0
+            if delta and new_cards:
+                delta_path = os.path.join(output_dir, f"{stem}.delta.apkg")
+                builder.write_to_file(delta_path, since=since)
+                print(f"  {new_cards} new or updated cards -> {delta_path}")
+            elif delta and since is not None:
+                print("  no new or updated cards since the previous run")
+            builder.checkpoint()
+        print(f"  {builder.dedup_report()}")
+        if builder.replaced_cards:
+            print(f"  {path}: {builder.replaced_report()}", file=sys.stderr)
+        for request, error in builder.failed_audio:
+            print(f"  {path}: no audio for {request.text!r}: {error}", file=sys.stderr)
+        if builder.audio_options.enabled:
+            print(f"  {builder.audio_report()}")
+        if getattr(backend, "join", False):
+            print(f"  {backend.join_report()}")
+    finally:
+        builder.close()
+    return output_path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build Anki decks from text files.")
+    parser.add_argument("files", nargs="+", help="Input files, one card per row")
+    parser.add_argument("-l", "--language", default="de", help="gTTS language code")
+    parser.add_argument("-m", "--mode", choices=MODES, default="lexicon")
+    parser.add_argument("-o", "--output-dir", default=".")
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        help="Concurrent TTS calls (default depends on the backend)",
+    )
+    parser.add_argument(
+        "--tts",
+        choices=list(BACKENDS),
+        help="Speech engine (default LCG_TTS_BACKEND, gtts otherwise)",
+    )
+    parser.add_argument("--deck-name", help="Deck name (default depends on mode)")
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=FORMATS,
+        help="Input format (default from the file extension, text otherwise)",
+    )
+    parser.add_argument(
+        "--strict", action="store_true", help="Fail a file if any row is rejected"
+    )
+    parser.add_argument(
+        "--compact-audio",
+        action="store_true",
+        help="Trim silence and re-encode clips with ffmpeg (as LCG_AUDIO_COMPACT=1)",
+    )
+    parser.add_argument(
+        "--join-speech",
+        action="store_true",
+        help="Synthesize short gTTS utterances together and split them with "
+        "ffmpeg (as LCG_TTS_JOIN=1)",
+    )
+    parser.add_argument(
+        "--append",
+        action="store_true",
+        help="Add the cards to the deck of the same name in the deck store "
+        "(LCG_DECK_STORE) and package the whole deck",
+    )
+    parser.add_argument(
+        "--delta",
+        action="store_true",
+        help="With --append, also package only the cards added or changed since "
+        "the previous run, as <name>.delta.apkg",
+    )
+    parser.add_argument(
+        "--metrics",
+        metavar="PATH",
+        help="Write stage timings and counters to PATH (Prometheus text if it "
+        "ends in .prom, JSON otherwise)",
+    )
+    args = parser.parse_args(argv)
+    if args.delta and not args.append:
+        parser.error("--delta requires --append")
+
+    metrics = Metrics() if args.metrics else NULL_METRICS
+    os.makedirs(args.output_dir, exist_ok=True)
+    failures = 0
+    for path in args.files:
+        start = time.perf_counter()
+        try:
+            build_deck(
+                path,
+                args.language,
+                args.mode,
+                args.output_dir,
+                workers=args.workers,
+                deck_name=args.deck_name,
+                fmt=args.format,
+                strict=args.strict,
+                metrics=metrics,
+                tts_backend=args.tts,
+                compact_audio=args.compact_audio,
+                append=args.append,
+                delta=args.delta,
+                join_speech=args.join_speech,
+            )
+        except Exception as e:
+            failures += 1
+            print(f"{path}: failed: {e}", file=sys.stderr)
+            continue
+        print(f"  built in {time.perf_counter() - start:.1f}s")
+
+    if args.metrics:
+        with open(args.metrics, "w", encoding="utf-8") as f:
+            if args.metrics.endswith(".prom"):
+                f.write(metrics.to_prometheus())
+            else:
+                f.write(metrics.to_json())
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
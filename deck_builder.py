@@ -0,0 +1,618 @@
+import hashlib
+import io
+import os
+import re
+from contextlib import nullcontext
+from typing import Callable
+
+import genanki
+
+from audio import AudioOptions, compact_clips, ffmpeg_available
+from images import ImageOptions, normalize_images
+from deck_store import DeckStore
+from media_store import MediaStore, StorePackage
+from metrics import NULL_METRICS, Metrics
+from parsing import CardRecord, ParseReport, iter_cards
+from tts import SpeechRequest, TTSBackend, get_backend, synthesize, synthesize_many
+
+MODES = ["lexicon", "pronunciation", "grammar"]
+
+# Default deck id and name per mode and language
+DECK_INFO = {
+    "lexicon": {
+        "de": (87654321, "Deutsch"),
+        "es": (87654322, "Espanol"),
+        "fr": (87654323, "Francais"),
+    },
+    "pronunciation": {
+        "de": (100234568, "DeutschAussprache"),
+        "es": (100234569, "EspanolPronunciacion"),
+        "fr": (100234570, "FrancaisPrononciation"),
+    },
+    "grammar": {
+        "de": (1234567, "Grammar_Deutsch"),
+        "es": (1234568, "Grammar_Espanol"),
+        "fr": (1234569, "Grammar_Francais"),
+    },
+}
+
+# Common CSS style
+CSS = """.card{
+    font-family: arial;
+    font-size: 20px;
+    text-align: center;
+    color: black;
+    background-color: white;
+    }"""
+
+# Models are immutable, so they are built once per process
+MODELS = {
+    # Original lexicon model
+    "lexicon": genanki.Model(
+        1284830180,
+        "Language (and reversed card) card generator",
+        fields=[
+            {"name": "baseS"},
+            {"name": "baseT"},
+            {"name": "AbaseT"},
+            {"name": "fullT"},
+            {"name": "AfullT"},
+            {"name": "s1T"},
+            {"name": "As1T"},
+            {"name": "s2T"},
+            {"name": "As2T"},
+            {"name": "image1"},
+            {"name": "image2"},
+        ],
+        templates=[
+            {
+                "name": "Card 1",
+                "qfmt": "{{baseS}}<br>{{image1}} {{image2}}",
+                "afmt": "{{baseS}}<br>{{image1}} {{image2}} <br> {{fullT}} {{AfullT}}"
+                '<hr id="answer">{{s1T}} {{As1T}}<br> {{s2T}} {{As2T}}',
+            },
+            {
+                "name": "Card 2",
+                "qfmt": "{{baseT}} {{AbaseT}}",
+                "afmt": "{{fullT}} {{AfullT}}<br>{{baseS}}"
+                '<hr id="answer">{{image1}} {{image2}}<br> {{s1T}}{{As1T}}<br> {{s2T}} {{As2T}}',
+            },
+        ],
+        css=CSS,
+    ),
+    # Pronunciation model (from AusspracheDeutsch.py)
+    "pronunciation": genanki.Model(
+        1081735104,
+        "Simple Model with Media",
+        fields=[
+            {"name": "Question"},
+            {"name": "MyMedia"},
+        ],
+        templates=[
+            {
+                "name": "Card 1",
+                "qfmt": "{{Question}}",
+                "afmt": '{{FrontSide}}<hr id="answer">{{MyMedia}}',
+            },
+        ],
+        css=CSS,
+    ),
+    # Grammar model (unified model that handles both with/without rules)
+    "grammar": genanki.Model(
+        1091735125,
+        "Simple Model with Media",
+        fields=[
+            {"name": "Question"},
+            {"name": "Answer"},
+            {"name": "MyMedia"},
+            {"name": "explanation"},
+        ],
+        templates=[
+            {
+                "name": "Card 1",
+                "qfmt": "{{Question}}",
+                "afmt": '{{FrontSide}}<hr id="answer">{{Answer}}<br>{{MyMedia}}<br>{{explanation}}',
+            },
+        ],
+        css=CSS,
+    ),
+}
+
+
+# Parser function
+def create_list_of_cards(
+    src_text: str, mode: str = "lexicon", report: ParseReport | None = None
+) -> list[CardRecord]:
+    """
+    Creates a list of card records corresponding to fields from a given text.
+
+    Args:
+        src_text (str): The text to parse
+        mode (str): The mode - "lexicon", "pronunciation", or "grammar"
+        report (ParseReport): Collects the rejected and incomplete lines
+
+    Returns:
+        list[CardRecord]: A list of records representing cards based on the mode
+    """
+    return list(iter_cards(io.StringIO(src_text), mode, report=report))
+
+
+def color_gender(field, selected_language):
+    if selected_language == "de":
+        if field.startswith("die "):
+            field = f'<span style="color: rgb(255, 88, 111);">{field}</span>'
+        elif field.startswith("das "):
+            field = f'<span style="color: rgb(88, 255, 101);">{field}</span>'
+        elif field.startswith("der "):
+            field = f'<span style="color: rgb(88, 141, 255);">{field}</span>'
+    return field
+
+
+def audio_requests(fields, selected_language, mode="lexicon"):
+    """Return the speech requests needed by a card, None for empty fields."""
+    if mode == "lexicon":
+        return [
+            SpeechRequest(fields[key], selected_language) if fields[key] else None
+            for key in ["baseT", "fullT", "s1T", "s2T"]
+        ]
+    elif mode == "pronunciation":
+        return [SpeechRequest(fields["word"], selected_language, tld="com")]
+    elif mode == "grammar":
+        return [SpeechRequest(fields["Back"], selected_language)]
+    return []
+
+
+def image_filename(data: bytes, extension: str = "jpg") -> str:
+    """Content-addressed media filename for an encoded image."""
+    return f"image_{hashlib.sha256(data).hexdigest()[:16]}.{extension}"
+
+
+# Note fields identifying a card, by position. The other fields can change
+# without the card becoming a new note.
+GUID_FIELDS = {
+    "lexicon": (1, 0),  # baseT, baseS: a word can have several meanings
+    "pronunciation": (0,),
+    "grammar": (0, 1),  # Front, Back: one prompt can have several answers
+}
+
+MEDIA_REFERENCE = re.compile(r'\[sound:([^\]]+)\]|<img src="([^"]+)"')
+
+
+def note_guid(mode: str, language: str, fields_note: list[str]) -> str:
+    """Stable GUID of a note, so that importing it again updates it in place."""
+    return genanki.guid_for(
+        mode, language, *(fields_note[i] for i in GUID_FIELDS[mode])
+    )
+
+
+def media_references(fields_note: list[str]) -> list[str]:
+    """Filenames of the sounds and images used by note fields, without repeats."""
+    found = []
+    for field in fields_note:
+        for sound, image in MEDIA_REFERENCE.findall(field):
+            found.append(sound or image)
+    return list(dict.fromkeys(found))
+
+
+class DeckBuilder:
+    """
+    Builds an Anki deck for one language and mode, independently of any UI.
+
+    Audio comes from ``tts_backend`` (the configured default backend when
+    None). Media files are kept in a MediaStore owned by the builder and
+    released by ``close``. Media names are content-addressed, so a file already
+    in the deck is neither stored, compacted nor packaged again.
+
+    With a ``store``, the deck ``deck_key`` is reopened from it: its notes are
+    loaded, media it already holds are not synthesized again, and every note
+    and media file added is saved to the store as well.
+    """
+
+    def __init__(
+        self,
+        language: str,
+        mode: str = "lexicon",
+        deck_id: int | None = None,
+        deck_name: str | None = None,
+        media_store: MediaStore | None = None,
+        image_options: ImageOptions | None = None,
+        metrics: Metrics = NULL_METRICS,
+        tts_backend: TTSBackend | None = None,
+        audio_options: AudioOptions | None = None,
+        store: DeckStore | None = None,
+        deck_key: str | None = None,
+    ):
+        if mode not in MODES:
+            raise ValueError(f"Unknown mode {mode!r}, expected one of {MODES}")
+        default_id, default_name = DECK_INFO[mode].get(
+            language, list(DECK_INFO[mode].values())[0]
+        )
+        self.language = language
+        self.mode = mode
+        deck_id, deck_name = deck_id or default_id, deck_name or default_name
+        self.store = store
+        self.deck_key = deck_key or deck_name
+        if store is not None:
+            deck_id, deck_name = store.open_deck(
+                self.deck_key, deck_id, deck_name, language, mode
+            )
+            media_store = store.media(self.deck_key)
+        self.deck = genanki.Deck(deck_id, deck_name)
+        self.media = media_store if media_store is not None else MediaStore()
+        self.version = 0  # Increased by every note added or updated
+        self.checkpoints = []  # Versions of the deck at each export, oldest first
+        self._note_index = {}  # GUID -> position in self.deck.notes
+        self._note_versions = []  # Version of each note in self.deck.notes
+        if store is not None:
+            for guid, version, fields_note in store.notes(self.deck_key):
+                guid = guid or note_guid(mode, language, fields_note)
+                note = genanki.Note(model=MODELS[mode], fields=fields_note, guid=guid)
+                self._put_note(note, version)
+            self.version = max(self._note_versions, default=0)
+            self.checkpoints = store.checkpoints(self.deck_key)
+        self.dedup_saved_bytes = 0
+        self.image_options = image_options or ImageOptions.from_env()
+        self.image_source_bytes = 0  # Size of the images as downloaded
+        self.image_output_bytes = 0  # Size of the same images after normalization
+        self.metrics = metrics
+        self.tts = tts_backend or get_backend()
+        self.audio_options = audio_options or AudioOptions.from_env()
+        if self.audio_options.enabled and not ffmpeg_available():
+            raise RuntimeError("Audio compaction needs ffmpeg, which was not found")
+        self.audio_source_bytes = 0  # Size of the clips as synthesized
+        self.audio_output_bytes = 0  # Size of the same clips after compaction
+        # Original filenames of the clips kept as synthesized, not compacted
+        self._uncompacted = set()
+        self.failed_audio = []  # (SpeechRequest, error) pairs given up on
+        # Identifying fields of the cards of add_cards that replaced an earlier one
+        self.replaced_cards = []
+        self._batch_guids = set()  # GUIDs of the notes added by add_cards
+
+    def _put_note(self, note: genanki.Note, version: int):
+        """Add a note, replacing the note with the same GUID if there is one."""
+        index = self._note_index.get(note.guid)
+        if index is None:
+            self._note_index[note.guid] = len(self.deck.notes)
+            self.deck.notes.append(note)
+            self._note_versions.append(version)
+        else:
+            self.deck.notes[index] = note
+            self._note_versions[index] = version
+
+    def add_media(self, filename: str, data: bytes):
+        """Add a media file to the deck, counting duplicates as saved bytes."""
+        if not self.media.add(filename, data):
+            self.dedup_saved_bytes += self.media.size(filename)
+
+    def normalize_images(self, images: list[bytes], processes=None) -> list[bytes]:
+        """Normalize images with the builder's options and track the bytes saved."""
+        if not images:
+            return []
+        with self.metrics.stage("image_normalize", items=len(images)):
+            normalized = normalize_images(images, self.image_options, processes)
+        self.metrics.add_bytes("image_normalize", sum(len(d) for d in normalized))
+        self.image_source_bytes += sum(len(data) for data in images)
+        self.image_output_bytes += sum(len(data) for data in normalized)
+        return normalized
+
+    def sound_filename(self, request: SpeechRequest) -> str:
+        """Media filename of the clip of ``request`` in this deck."""
+        original = self.tts.media_filename(request)
+        if not self.audio_options.enabled:
+            return original
+        name = self.audio_options.filename(self.tts.cache_key(request))
+        # A clip that could not be compacted keeps its own format and name
+        if original in self._uncompacted or (
+            name not in self.media and original in self.media
+        ):
+            return original
+        return name
+
+    def compact_audio(self, clips: list[bytes], workers=None) -> list[bytes | None]:
+        """
+        Compact clips with the builder's options and track the bytes saved.
+
+        Returns the compacted clips, None for those kept as they are.
+        """
+        if not clips or not self.audio_options.enabled:
+            return [None] * len(clips)
+        with self.metrics.stage("audio_compact", items=len(clips)):
+            compacted = compact_clips(clips, self.audio_options, workers)
+        kept = [new or old for new, old in zip(compacted, clips)]
+        self.metrics.add_bytes("audio_compact", sum(len(d) for d in kept))
+        self.audio_source_bytes += sum(len(data) for data in clips)
+        self.audio_output_bytes += sum(len(data) for data in kept)
+        return compacted
+
+    def _compact_new(
+        self, requests: list[SpeechRequest | None], clips: list[bytes | None]
+    ) -> list[bytes | None]:
+        # Compact the clips that are not in the deck yet, each once. Those that
+        # stay as they are get their original filename from sound_filename.
+        new = {}
+        for request, clip in zip(requests, clips):
+            if request is not None and clip is not None:
+                name = self.sound_filename(request)
+                if name not in self.media:
+                    new.setdefault(name, (request, clip))
+        compacted = self.compact_audio([clip for _, clip in new.values()])
+        results = {}
+        for (name, (request, _)), data in zip(new.items(), compacted):
+            if data is None:
+                self._uncompacted.add(self.tts.media_filename(request))
+            else:
+                results[name] = data
+        return [
+            None if clip is None else results.get(self.sound_filename(request), clip)
+            for request, clip in zip(requests, clips)
+        ]
+
+    def add_card(
+        self, fields: CardRecord, clips=None, images=(), normalized=False
+    ) -> genanki.Note:
+        """
+        Create a note from a parsed card and add it to the deck.
+
+        Args:
+            fields (CardRecord): The card, as returned by create_list_of_cards
+            clips (list): The clips for ``audio_requests(fields, ...)``, in the
+                same order. Missing clips are synthesized on the spot, unless
+                already in the deck; other None entries are left without sound.
+            images (list[bytes]): Encoded images, lexicon mode only
+            normalized (bool): Whether ``images`` and ``clips`` already went
+                through normalize_images and compact_audio
+
+        Returns:
+            genanki.Note: The note added to the deck
+        """
+        speech_requests = audio_requests(fields, self.language, self.mode)
+        if clips is None:
+            # Identical fields (e.g. baseT and fullT of adjectives) are synthesized once
+            unique = {}
+            for r in dict.fromkeys(speech_requests):
+                if r is not None and self.sound_filename(r) not in self.media:
+                    with self.metrics.stage("tts_request", items=1):
+                        unique[r] = synthesize(r, self.tts)
+            clips = [unique.get(request) for request in speech_requests]
+
+        if not normalized and self.audio_options.enabled:
+            clips = self._compact_new(speech_requests, clips)
+
+        filenames = []
+        for request, clip in zip(speech_requests, clips):
+            name = self.sound_filename(request) if request is not None else None
+            if clip is None and name not in self.media:
+                name = None  # Failed clip (see add_cards), added without sound
+            filenames.append(name)
+
+        sounds = []
+        for filename, clip in zip(filenames, clips):
+            if filename is None:
+                sounds.append("")
+                continue
+            if clip is None:
+                self.dedup_saved_bytes += self.media.size(filename)
+            else:
+                self.add_media(filename, clip)
+            sounds.append(f"[sound:{filename}]")
+
+        if self.mode == "lexicon":
+            fields_note = [fields["baseS"]]
+            for key, sound in zip(["baseT", "fullT", "s1T", "s2T"], sounds):
+                value = fields[key]
+                if key == "fullT" and value:
+                    value = color_gender(value, self.language)
+                fields_note.extend([value, sound])
+
+            # Add images dynamically
+            if not normalized:
+                images = self.normalize_images(images)
+            image_tags = []
+            for data in images:
+                filename = image_filename(data, self.image_options.extension)
+                self.add_media(filename, data)
+                image_tags.append(f'<img src="{filename}">')
+            while len(image_tags) < 2:  # Ensure 2 image placeholders
+                image_tags.append("")
+            fields_note.extend(image_tags)
+
+        elif self.mode == "pronunciation":
+            fields_note = [fields["word"], sounds[0]]
+
+        else:  # grammar
+            fields_note = [
+                fields["Front"],
+                fields["Back"],
+                sounds[0],
+                fields.get("Rule", ""),  # Empty string if no rule
+            ]
+
+        # A card added again (e.g. with edited sentences) updates its note
+        note = genanki.Note(
+            model=MODELS[self.mode],
+            fields=fields_note,
+            guid=note_guid(self.mode, self.language, fields_note),
+        )
+        index = self._note_index.get(note.guid)
+        if index is not None and self.deck.notes[index].fields == fields_note:
+            return self.deck.notes[index]  # Unchanged, so not a new version
+        self.version += 1
+        self._put_note(note, self.version)
+        if self.store is not None:
+            self.store.add_note(self.deck_key, note.guid, self.version, fields_note)
+        self.metrics.add_items("notes")
+        return note
+
+    def add_cards(
+        self,
+        cards: list[CardRecord],
+        images: list[list[bytes]] | None = None,
+        max_workers: int | None = None,
+        retries: int = 3,
+        on_progress: Callable[[int, int], None] | None = None,
+    ):
+        """
+        Synthesize the audio of all cards concurrently, then add them in order.
+
+        ``images`` optionally gives the images of each card; they are encoded
+        in a process pool. ``on_progress`` is called as on_progress(done, total)
+        while the audio is being synthesized. Clips that still fail after
+        ``retries`` are recorded in ``failed_audio`` and their cards are added
+        without that sound, so one failure does not abort the build.
+        """
+        if images is None:
+            images = [[] for _ in cards]
+        flat_images = [data for card_images in images for data in card_images]
+        normalized = iter(self.normalize_images(flat_images))
+
+        requests_per_card = [
+            audio_requests(card, self.language, self.mode) for card in cards
+        ]
+        all_requests = [
+            request
+            for card_requests in requests_per_card
+            for request in card_requests
+            if request is not None
+        ]
+        # Clips already in the deck, e.g. from an earlier session, are reused
+        missing = [r for r in all_requests if self.sound_filename(r) not in self.media]
+        with self.metrics.stage("tts", items=len(missing)):
+            clips = synthesize_many(
+                missing,
+                max_workers=max_workers,
+                retries=retries,
+                on_progress=on_progress,
+                metrics=self.metrics,
+                backend=self.tts,
+                failed=self.failed_audio,
+            )
+        synthesized = dict(zip(missing, clips))
+        clips = [synthesized.get(request) for request in all_requests]
+        if self.audio_options.enabled:
+            # Across all cards, so that a clip used twice is compacted once
+            clips = self._compact_new(all_requests, clips)
+        clips = iter(clips)
+        # One commit for the whole batch when the deck is stored
+        with self.store.transaction() if self.store is not None else nullcontext():
+            for card, card_requests, card_images in zip(
+                cards, requests_per_card, images
+            ):
+                note = self.add_card(
+                    card,
+                    clips=[
+                        next(clips) if r is not None else None for r in card_requests
+                    ],
+                    images=[next(normalized) for _ in card_images],
+                    normalized=True,
+                )
+                # Same identifying fields as an earlier card of the input
+                if note.guid in self._batch_guids:
+                    self.replaced_cards.append(
+                        " / ".join(note.fields[i] for i in GUID_FIELDS[self.mode])
+                    )
+                self._batch_guids.add(note.guid)
+
+    @property
+    def file_name(self) -> str:
+        return f"{self.deck.name}.apkg"
+
+    @property
+    def delta_file_name(self) -> str:
+        return f"{self.deck.name} (new cards).apkg"
+
+    def notes_since(self, version: int) -> list[genanki.Note]:
+        """The notes added or updated after ``version`` of the deck."""
+        return [
+            note
+            for note, note_version in zip(self.deck.notes, self._note_versions)
+            if note_version > version
+        ]
+
+    def checkpoint(self, version: int | None = None) -> int:
+        """
+        Record that the deck was exported at ``version`` (by default the
+        current one), e.g. when its package is downloaded, and return it.
+        """
+        version = self.version if version is None else version
+        if self.last_checkpoint == version:
+            return version
+        self.checkpoints.append(version)
+        if self.store is not None:
+            self.store.add_checkpoint(self.deck_key, version)
+        return version
+
+    @property
+    def last_checkpoint(self) -> int | None:
+        return self.checkpoints[-1] if self.checkpoints else None
+
+    def write_to_file(self, file, since: int | None = None):
+        """
+        Write the .apkg package to a path or a binary file object.
+
+        Only the media files used by the packaged notes are included, e.g. not
+        the clip of a card replaced since. With ``since``, only the notes added
+        or updated after that version (e.g. ``last_checkpoint``) are packaged,
+        together with the media files that no earlier note uses.
+        """
+        deck, shipped = self.deck, set()
+        if since is not None:
+            deck = genanki.Deck(self.deck.deck_id, self.deck.name)
+            deck.notes = self.notes_since(since)
+            shipped = {
+                filename
+                for note, version in zip(self.deck.notes, self._note_versions)
+                if version <= since
+                for filename in media_references(note.fields)
+            }
+        media_files = list(
+            dict.fromkeys(
+                filename
+                for note in deck.notes
+                for filename in media_references(note.fields)
+                if filename not in shipped and filename in self.media
+            )
+        )
+        with self.metrics.stage("package", items=len(deck.notes)):
+            StorePackage(deck, self.media, media_files).write_to_file(file)
+        if self.metrics.enabled:
+            size = file.tell() if hasattr(file, "tell") else os.path.getsize(file)
+            self.metrics.add_bytes("package", size)
+
+    def dedup_report(self) -> str:
+        """Describe the media deduplicated in the deck."""
+        shipped = self.media.total_bytes
+        return (
+            f"{len(self.media)} unique media files ({shipped / 1024:.1f} KiB), "
+            f"deduplication saved {self.dedup_saved_bytes / 1024:.1f} KiB"
+        )
+
+    def image_report(self) -> str:
+        """Describe the bytes saved by image normalization."""
+        saved = self.image_source_bytes - self.image_output_bytes
+        return (
+            f"Images: {self.image_source_bytes / 1024:.1f} KiB downloaded, "
+            f"{self.image_output_bytes / 1024:.1f} KiB after normalization, "
+            f"saved {saved / 1024:.1f} KiB"
+        )
+
+    def replaced_report(self) -> str:
+        """Describe the cards that replaced an earlier card with the same fields."""
+        shown = ", ".join(repr(card) for card in self.replaced_cards[:5])
+        more = ", ..." if len(self.replaced_cards) > 5 else ""
+        return (
+            f"{len(self.replaced_cards)} cards replaced an earlier card of the "
+            f"same word or prompt: {shown}{more}"
+        )
+
+    def audio_report(self) -> str:
+        """Describe the bytes saved by audio compaction."""
+        saved = self.audio_source_bytes - self.audio_output_bytes
+        return (
+            f"Audio: {self.audio_source_bytes / 1024:.1f} KiB synthesized, "
+            f"{self.audio_output_bytes / 1024:.1f} KiB after compaction, "
+            f"saved {saved / 1024:.1f} KiB"
+        )
+
+    def close(self):
+        """Release the media held by the builder."""
+        self.media.close()
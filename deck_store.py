@@ -0,0 +1,346 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import zipfile
+from contextlib import contextmanager
+
+from media_store import MediaStore
+from parsing import RECORD_TYPES, CardRecord
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS decks (
+    key TEXT PRIMARY KEY,
+    deck_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    language TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    created REAL NOT NULL,
+    used REAL
+);
+CREATE TABLE IF NOT EXISTS notes (
+    id INTEGER PRIMARY KEY,
+    deck TEXT NOT NULL REFERENCES decks(key),
+    fields TEXT NOT NULL,
+    created REAL NOT NULL,
+    guid TEXT,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS notes_deck ON notes(deck, id);
+CREATE TABLE IF NOT EXISTS media (
+    filename TEXT PRIMARY KEY,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS deck_media (
+    deck TEXT NOT NULL REFERENCES decks(key),
+    filename TEXT NOT NULL REFERENCES media(filename),
+    PRIMARY KEY (deck, filename)
+);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    deck TEXT NOT NULL REFERENCES decks(key),
+    version INTEGER NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    deck TEXT PRIMARY KEY REFERENCES decks(key),
+    cards TEXT NOT NULL,
+    current_card INTEGER NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+
+class DeckStore:
+    """
+    SQLite file holding the notes and media of decks across sessions.
+
+    Decks are identified by an opaque key. Media are content-addressed, so they
+    are stored once however many decks use them, and a deck that is reopened
+    never synthesizes or downloads again what it already holds. The unfinished
+    review of a deck can be saved too, and resumed from another session.
+
+    Decks not used for ``max_age`` seconds are deleted, together with the media
+    no other deck uses, at most once per ``expire_interval``. A deck is used
+    when it is opened or gets notes, checkpoints or a saved review.
+    """
+
+    expire_interval = 3600.0
+
+    def __init__(self, path: str, max_age: float | None = None):
+        self.path = path
+        self.max_age = max_age
+        self._last_expiry = float("-inf")
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # One connection shared by all sessions, serialized by the lock
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._migrate()
+        self.expire()
+
+    def _migrate(self):
+        # Stores created before notes had a GUID and a version
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(notes)")}
+        deck_columns = {
+            row[1] for row in self._conn.execute("PRAGMA table_info(decks)")
+        }
+        with self.transaction():
+            if "guid" not in columns:
+                self._conn.execute("ALTER TABLE notes ADD COLUMN guid TEXT")
+                self._conn.execute(
+                    "ALTER TABLE notes ADD COLUMN version INTEGER NOT NULL DEFAULT 0"
+                )
+            self._conn.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS notes_guid ON notes(deck, guid)"
+            )
+            # ... and before decks expired
+            if "used" not in deck_columns:
+                self._conn.execute("ALTER TABLE decks ADD COLUMN used REAL")
+            self._conn.execute("UPDATE decks SET used = created WHERE used IS NULL")
+
+    def _touch(self, deck: str):
+        self._conn.execute(
+            "UPDATE decks SET used = ? WHERE key = ?", (time.time(), deck)
+        )
+
+    def expire(self) -> int:
+        """Delete the decks not used for ``max_age`` and return how many."""
+        if self.max_age is None:
+            return 0
+        cutoff = time.time() - self.max_age
+        with self.transaction():
+            self._last_expiry = time.monotonic()
+            expired = [
+                key
+                for (key,) in self._conn.execute(
+                    "SELECT key FROM decks WHERE used < ?", (cutoff,)
+                )
+            ]
+            for table in ("notes", "deck_media", "checkpoints", "sessions"):
+                self._conn.executemany(
+                    f"DELETE FROM {table} WHERE deck = ?", [(key,) for key in expired]
+                )
+            self._conn.executemany(
+                "DELETE FROM decks WHERE key = ?", [(key,) for key in expired]
+            )
+            # Media are shared between decks, so only those left unused go
+            if expired:
+                self._conn.execute(
+                    "DELETE FROM media WHERE filename NOT IN "
+                    "(SELECT filename FROM deck_media)"
+                )
+        return len(expired)
+
+    @contextmanager
+    def transaction(self):
+        """Group writes into a single commit, e.g. the notes of a batch."""
+        with self._lock:
+            self._depth += 1
+            try:
+                yield
+            except BaseException:
+                self._depth -= 1
+                if not self._depth:
+                    self._conn.rollback()
+                raise
+            self._depth -= 1
+            if not self._depth:
+                self._conn.commit()
+
+    def _execute(self, sql: str, params=()) -> sqlite3.Cursor:
+        with self.transaction():
+            return self._conn.execute(sql, params)
+
+    def open_deck(
+        self, key: str, deck_id: int, name: str, language: str, mode: str
+    ) -> tuple[int, str]:
+        """Create the deck ``key`` if needed and return its (deck id, name)."""
+        if time.monotonic() - self._last_expiry > self.expire_interval:
+            self.expire()
+        with self.transaction():
+            row = self._conn.execute(
+                "SELECT deck_id, name, mode FROM decks WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                now = time.time()
+                self._conn.execute(
+                    "INSERT INTO decks VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, deck_id, name, language, mode, now, now),
+                )
+                return deck_id, name
+            self._touch(key)
+        if row[2] != mode:
+            raise ValueError(f"Deck {key!r} holds {row[2]} cards, not {mode}")
+        return row[0], row[1]
+
+    def deck(self, key: str) -> dict | None:
+        """Language, mode and name of a stored deck, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT language, mode, name FROM decks WHERE key = ?", (key,)
+            ).fetchone()
+        return None if row is None else dict(zip(("language", "mode", "name"), row))
+
+    def notes(self, deck: str) -> list[tuple[str | None, int, list[str]]]:
+        """
+        (GUID, version, fields) of the notes of a deck, in the order they were
+        added. The GUID is None for notes stored before GUIDs were recorded.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT guid, version, fields FROM notes WHERE deck = ? ORDER BY id",
+                (deck,),
+            ).fetchall()
+        return [(guid, version, json.loads(fields)) for guid, version, fields in rows]
+
+    def add_note(self, deck: str, guid: str, version: int, fields: list[str]):
+        """Add a note, or update the note of the deck with the same GUID."""
+        with self.transaction():
+            updated = self._conn.execute(
+                "UPDATE notes SET fields = ?, version = ? WHERE deck = ? AND guid = ?",
+                (json.dumps(fields), version, deck, guid),
+            ).rowcount
+            if not updated:
+                self._conn.execute(
+                    "INSERT INTO notes (deck, fields, created, guid, version) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (deck, json.dumps(fields), time.time(), guid, version),
+                )
+            self._touch(deck)
+
+    def checkpoints(self, deck: str) -> list[int]:
+        """Note versions of a deck at each of its exports, oldest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT version FROM checkpoints WHERE deck = ? ORDER BY rowid",
+                (deck,),
+            ).fetchall()
+        return [version for (version,) in rows]
+
+    def add_checkpoint(self, deck: str, version: int):
+        with self.transaction():
+            self._conn.execute(
+                "INSERT INTO checkpoints VALUES (?, ?, ?)", (deck, version, time.time())
+            )
+            self._touch(deck)
+
+    def media(self, deck: str) -> "StoredMedia":
+        """The media of a deck, as a MediaStore that writes through to the file."""
+        return StoredMedia(self, deck)
+
+    def save_session(self, deck: str, cards: list[CardRecord], current_card: int):
+        """Save the cards under review in a deck and the position of the review."""
+        with self.transaction():
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)",
+                (
+                    deck,
+                    json.dumps([card.to_dict() for card in cards]),
+                    current_card,
+                    time.time(),
+                ),
+            )
+            self._touch(deck)
+
+    def load_session(self, deck: str) -> tuple[list[CardRecord], int] | None:
+        """Return the saved (cards, current card) of a deck, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT s.cards, s.current_card, d.mode FROM sessions s "
+                "JOIN decks d ON d.key = s.deck WHERE s.deck = ?",
+                (deck,),
+            ).fetchone()
+        if row is None:
+            return None
+        record_type = RECORD_TYPES[row[2]]
+        return [record_type(**card) for card in json.loads(row[0])], row[1]
+
+    def discard_session(self, deck: str):
+        self._execute("DELETE FROM sessions WHERE deck = ?", (deck,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class StoredMedia(MediaStore):
+    """The media files of one deck in a DeckStore."""
+
+    def __init__(self, store: DeckStore, deck: str):
+        super().__init__(spill_threshold=0)
+        self.store = store
+        self.deck = deck
+        with store._lock:
+            rows = store._conn.execute(
+                "SELECT m.filename, length(m.data) FROM deck_media dm "
+                "JOIN media m ON m.filename = dm.filename WHERE dm.deck = ? "
+                "ORDER BY dm.rowid",
+                (deck,),
+            ).fetchall()
+        self._sizes = dict(rows)
+
+    def add(self, filename: str, data: bytes) -> bool:
+        with self._lock:
+            if filename in self._sizes:
+                return False
+            with self.store.transaction():
+                # Possibly already stored for another deck
+                self.store._conn.execute(
+                    "INSERT OR IGNORE INTO media VALUES (?, ?)", (filename, data)
+                )
+                self.store._conn.execute(
+                    "INSERT OR IGNORE INTO deck_media VALUES (?, ?)",
+                    (self.deck, filename),
+                )
+            self._sizes[filename] = len(data)
+            return True
+
+    def read(self, filename: str) -> bytes:
+        with self.store._lock:
+            (data,) = self.store._conn.execute(
+                "SELECT data FROM media WHERE filename = ?", (filename,)
+            ).fetchone()
+        return data
+
+    def write_to_zip(self, outzip: zipfile.ZipFile, filename: str, arcname: str):
+        outzip.writestr(arcname, self.read(filename))
+
+    def close(self):
+        # The files stay in the store; only the index is dropped
+        with self._lock:
+            self._sizes.clear()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_deck_store() -> DeckStore:
+    """
+    Return the process-wide deck store.
+
+    Its file is LCG_DECK_STORE, by default decks.sqlite3 in
+    ~/.local/share/languagecardsgenerator. Decks unused for LCG_DECK_STORE_DAYS
+    days (30 by default, 0 to keep them forever) are deleted.
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            path = os.environ.get(
+                "LCG_DECK_STORE",
+                os.path.join(
+                    os.path.expanduser("~"),
+                    ".local",
+                    "share",
+                    "languagecardsgenerator",
+                    "decks.sqlite3",
+                ),
+            )
+            days = float(os.environ.get("LCG_DECK_STORE_DAYS", "30"))
+            _store = DeckStore(path, days * 86400 if days > 0 else None)
+        return _store
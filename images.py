@@ -0,0 +1,265 @@
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from io import BytesIO
+from typing import NamedTuple
+
+from bs4 import BeautifulSoup, SoupStrainer
+from PIL import Image, ImageOps
+
+from net import get_session
+from ratelimit import get_limiter
+
+
+class TTLCache:
+    """Thread-safe mapping whose entries expire ``ttl`` seconds after insertion."""
+
+    def __init__(self, ttl: float, max_entries: int = 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}  # Key -> (expiry time, value), oldest first
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            while len(self._entries) > self.max_entries:
+                del self._entries[next(iter(self._entries))]
+
+
+# Search results are shared by all sessions of the process
+_search_cache = TTLCache(ttl=float(os.environ.get("LCG_IMAGE_SEARCH_TTL", "3600")))
+# Failed searches are remembered briefly, so they are not retried on every rerun
+_failed_searches = TTLCache(
+    ttl=float(os.environ.get("LCG_IMAGE_SEARCH_FAILURE_TTL", "30"))
+)
+_pending_searches = {}  # (keyword, subdomain) -> Future of a running search
+_pending_lock = threading.Lock()
+_prefetch_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="prefetch")
+
+
+def _search_image_urls(
+    keyword: str, subdomain: str, background: bool = False
+) -> list[str] | None:
+    # Starting from a keyword, creates a list of URLs which direct to images.
+    # In the background, the search is skipped (None) unless Google can take it
+    # at once, so that the searches users wait for get the rate limit first.
+    limiter = get_limiter("google")
+    if background and not limiter.try_acquire():
+        return None
+
+    # Create a Google Images URL for the search term
+    search_url = f"https://www.google.{subdomain}/search"
+    # Send an HTTP GET request to the URL
+    # Shared by all sessions, so concurrent users cannot get the process blocked
+    try:
+        with limiter.limit(acquire=not background):
+            response = get_session().get(
+                search_url, params={"q": keyword, "tbm": "isch"}, timeout=10
+            )
+            response.raise_for_status()
+    except Exception as e:
+        _failed_searches.put((keyword, subdomain), e)
+        raise
+    # Parse only the <img> tags of the page
+    soup = BeautifulSoup(response.text, "html.parser", parse_only=SoupStrainer("img"))
+    list_of_urls = [tag.get("src") for tag in soup.find_all("img") if tag.get("src")]
+    # On google image, first one is google logo
+    list_of_urls = list_of_urls[1:]
+    _search_cache.put((keyword, subdomain), list_of_urls)
+    return list_of_urls
+
+
+def _submit_search(keyword: str, subdomain: str) -> Future:
+    """Start a search in the background unless the same one is already running."""
+    key = (keyword, subdomain)
+    with _pending_lock:
+        future = _pending_searches.get(key)
+        if future is not None:
+            return future
+        future = _prefetch_executor.submit(_search_image_urls, keyword, subdomain, True)
+        _pending_searches[key] = future
+    # Outside the lock: the callback runs immediately if the search already ended
+    future.add_done_callback(lambda _: _forget_search(key))
+    return future
+
+
+def _forget_search(key):
+    with _pending_lock:
+        _pending_searches.pop(key, None)
+
+
+def get_image_urls(keyword: str, subdomain: str) -> list[str]:
+    """
+    Return the image URLs found for ``keyword`` on Google Images.
+
+    Results are cached for LCG_IMAGE_SEARCH_TTL seconds. If the same search is
+    already being prefetched, its result is awaited instead of searching again;
+    otherwise the search runs in the calling thread.
+    Failed searches raise the error of the request, which is cached for
+    LCG_IMAGE_SEARCH_FAILURE_TTL seconds (30 by default).
+    """
+    key = (keyword, subdomain)
+    error = _failed_searches.get(key)
+    if error is not None:
+        raise error
+    urls = _search_cache.get(key)
+    if urls is not None:
+        return list(urls)
+    with _pending_lock:
+        future = _pending_searches.get(key)
+    if future is not None:
+        urls = future.result()
+        if urls is not None:  # Not skipped
+            return list(urls)
+    # In the calling thread, not queued behind the prefetches of all sessions
+    return list(_search_image_urls(keyword, subdomain))
+
+
+def prefetch_image_urls(keywords: list[str], subdomain: str):
+    """
+    Search images for ``keywords`` in the background to warm the cache.
+
+    Nothing is searched while Google is throttling, and searches that would
+    have to wait for the rate limit are skipped, so that speculative searches
+    do not hold up the ones a user asked for.
+    """
+    if get_limiter("google").backing_off():
+        return
+    for keyword in keywords:
+        key = (keyword, subdomain)
+        if (
+            keyword
+            and _search_cache.get(key) is None
+            and _failed_searches.get(key) is None
+        ):
+            _submit_search(keyword, subdomain)
+
+
+def _fetch_image(url: str, timeout: float) -> bytes:
+    response = get_session().get(url, timeout=timeout)
+    response.raise_for_status()
+    # Fail early on anything that is not an image
+    Image.open(BytesIO(response.content)).verify()
+    return response.content
+
+
+def load_images(urls, timeout=10, deadline=15):
+    """
+    Download images from URLs concurrently.
+
+    The images are returned as downloaded, encoded bytes; see normalize_image
+    for the processing applied before they are added to a deck.
+
+    Args:
+        urls (list[str]): The image URLs
+        timeout (float): Timeout in seconds of each request
+        deadline (float): Maximum time in seconds to wait for all downloads
+
+    Returns:
+        tuple[list, list]: The image bytes, in the order of ``urls``, and a list of
+            (url, reason) pairs for the URLs that could not be loaded
+    """
+    if not urls:
+        return [], []
+
+    executor = ThreadPoolExecutor(max_workers=len(urls))
+    futures = [executor.submit(_fetch_image, url, timeout) for url in urls]
+    wait(futures, timeout=deadline)
+    # Do not block on downloads still running past the deadline
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    images, failed = [], []
+    for url, future in zip(urls, futures):
+        if not future.done():
+            failed.append((url, "deadline exceeded"))
+        elif future.exception() is not None:
+            failed.append((url, str(future.exception())))
+        else:
+            images.append(future.result())
+    return images, failed
+
+
+class ImageOptions(NamedTuple):
+    """How images are processed before being added to a deck."""
+
+    max_dimension: int = 800
+    format: str = "JPEG"  # "JPEG" or "WEBP"
+    quality: int = 80
+
+    @classmethod
+    def from_env(cls) -> "ImageOptions":
+        """Options from LCG_IMAGE_MAX_DIM, LCG_IMAGE_FORMAT and LCG_IMAGE_QUALITY."""
+        default = cls()
+        return cls(
+            int(os.environ.get("LCG_IMAGE_MAX_DIM", default.max_dimension)),
+            os.environ.get("LCG_IMAGE_FORMAT", default.format).upper(),
+            int(os.environ.get("LCG_IMAGE_QUALITY", default.quality)),
+        )
+
+    @property
+    def extension(self) -> str:
+        return {"JPEG": "jpg", "WEBP": "webp"}[self.format]
+
+
+def normalize_image(data: bytes, options: ImageOptions = ImageOptions()) -> bytes:
+    """
+    Downscale and recompress an encoded image.
+
+    The image is rotated according to its EXIF orientation, shrunk so that its
+    largest side is at most ``options.max_dimension``, flattened on white if it
+    has transparency and re-encoded without any metadata.
+    """
+    img = Image.open(BytesIO(data))
+    img = ImageOps.exif_transpose(img)
+    img.thumbnail((options.max_dimension, options.max_dimension))
+
+    if img.mode in ("RGBA", "LA") or "transparency" in img.info:
+        img = img.convert("RGBA")
+        background = Image.new("RGB", img.size, "white")
+        background.paste(img, mask=img.getchannel("A"))
+        img = background
+    elif img.mode != "RGB":
+        img = img.convert("RGB")
+
+    # Nothing from img.info is passed on, so EXIF and ICC data are dropped
+    output = BytesIO()
+    img.save(output, format=options.format, quality=options.quality, optimize=True)
+    return output.getvalue()
+
+
+def normalize_images(
+    images: list[bytes],
+    options: ImageOptions = ImageOptions(),
+    processes: int | None = None,
+) -> list[bytes]:
+    """
+    Normalize many images, encoding them in a process pool for large batches.
+
+    Args:
+        images (list[bytes]): The encoded images
+        options (ImageOptions): The processing options
+        processes (int): Size of the process pool, defaults to the CPU count
+
+    Returns:
+        list[bytes]: The normalized images, in the same order
+    """
+    # Starting a pool costs more than encoding a handful of images
+    if len(images) < 8 or processes == 1:
+        return [normalize_image(data, options) for data in images]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(
+            executor.map(normalize_image, images, [options] * len(images), chunksize=4)
+        )
@@ -0,0 +1,230 @@
+"""
+Local queue running batch deck builds in worker processes.
+
+A job runs the whole pronunciation or grammar pipeline of one deck. Its
+progress is written to ``status.json`` in the job's directory, so any session
+(for instance a reloaded browser tab) can poll it by job id, and the finished
+package is left next to it as ``deck.apkg``, with ``delta.apkg`` holding only
+the cards of a stored deck added since it was last downloaded.
+"""
+
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from deck_builder import DeckBuilder
+from deck_store import get_deck_store
+from metrics import NULL_METRICS, Metrics
+from parsing import CardRecord
+from ratelimit import connect_limiters, share_limiters
+from tts import get_audio_cache
+
+
+def _write_status(job_dir: str, status: dict):
+    # Atomic, so a poll never reads a half written file
+    fd, tmp_path = tempfile.mkstemp(dir=job_dir, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(status, f)
+    os.replace(tmp_path, os.path.join(job_dir, "status.json"))
+
+
+def _init_worker(address, authkey: bytes):
+    # Workers and the app use the same buckets, backoffs and circuits
+    connect_limiters(address, authkey)
+
+
+def run_build_job(
+    job_dir: str,
+    cards: list[CardRecord],
+    language: str,
+    mode: str,
+    collect_metrics: bool = False,
+    deck_key: str | None = None,
+):
+    """
+    Build a deck in a worker process, reporting progress in status.json.
+
+    With a ``deck_key`` the cards are appended to that deck of the deck store.
+    The deck is only recorded as exported once the session downloads it.
+    """
+    status = {"state": "running", "done": 0, "total": 0}
+    _write_status(job_dir, status)
+    metrics = Metrics() if collect_metrics else NULL_METRICS
+    last_write = 0.0
+
+    def on_progress(done, total):
+        nonlocal last_write
+        status.update(done=done, total=total)
+        if time.monotonic() - last_write > 0.2 or done == total:
+            last_write = time.monotonic()
+            _write_status(job_dir, status)
+
+    builder = DeckBuilder(
+        language,
+        mode,
+        metrics=metrics,
+        store=get_deck_store() if deck_key else None,
+        deck_key=deck_key,
+    )
+    try:
+        builder.add_cards(cards, on_progress=on_progress)
+        builder.write_to_file(os.path.join(job_dir, "deck.apkg"))
+        delta_file_name = None
+        if deck_key:
+            since = builder.last_checkpoint
+            if since is not None and builder.notes_since(since):
+                builder.write_to_file(os.path.join(job_dir, "delta.apkg"), since=since)
+                delta_file_name = builder.delta_file_name
+        reports = [builder.dedup_report()]
+        if builder.replaced_cards:
+            reports.append(builder.replaced_report())
+        if builder.audio_options.enabled:
+            reports.append(builder.audio_report())
+        audio_cache = get_audio_cache()
+        if audio_cache is not None:
+            stats = audio_cache.stats()
+            reports.append(
+                f"Audio cache: {stats['hits']} hits, {stats['misses']} misses"
+            )
+        status.update(
+            state="done",
+            file_name=builder.file_name,
+            delta_file_name=delta_file_name,
+            deck_key=deck_key,
+            version=builder.version,
+            reports=reports,
+            failed_audio=[
+                (request.text, str(error)) for request, error in builder.failed_audio
+            ],
+            metrics=metrics.to_dict(),
+        )
+    except Exception as e:
+        status.update(state="failed", error=f"{type(e).__name__}: {e}")
+    finally:
+        builder.close()
+    _write_status(job_dir, status)
+
+
+class Job:
+    def __init__(self, job_id: str, directory: str, mode: str, future: Future):
+        self.id = job_id
+        self.directory = directory
+        self.mode = mode
+        self.future = future
+        self.created = time.time()
+
+    @property
+    def result_path(self) -> str:
+        return os.path.join(self.directory, "deck.apkg")
+
+    @property
+    def delta_path(self) -> str:
+        return os.path.join(self.directory, "delta.apkg")
+
+    def status(self) -> dict:
+        """The last status written by the worker, with ``state`` always set."""
+        try:
+            with open(
+                os.path.join(self.directory, "status.json"), encoding="utf-8"
+            ) as f:
+                status = json.load(f)
+        except (OSError, ValueError):
+            status = {"state": "queued", "done": 0, "total": 0}
+        if status["state"] in ("queued", "running") and self.future.done():
+            # The worker died without a final status, e.g. killed
+            error = None if self.future.cancelled() else self.future.exception()
+            status.update(state="failed", error=str(error or "cancelled"))
+        return status
+
+
+class JobQueue:
+    """
+    Process-wide queue of deck builds.
+
+    ``workers`` processes (LCG_JOB_WORKERS, the CPU count by default) build
+    decks in parallel, for any number of sessions. Jobs not removed by their
+    session are deleted ``ttl`` seconds after submission.
+    """
+
+    def __init__(self, workers: int | None = None, ttl: float = 3600):
+        self.workers = workers or os.cpu_count() or 2
+        self.ttl = ttl
+        self.root = tempfile.mkdtemp(prefix="lcg_jobs_")
+        self._finalizer = weakref.finalize(
+            self, shutil.rmtree, self.root, ignore_errors=True
+        )
+        self._jobs = {}
+        self._lock = threading.Lock()
+        # Not forked: the Streamlit server has many threads
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=share_limiters(),
+        )
+
+    def submit(
+        self,
+        cards: list[CardRecord],
+        language: str,
+        mode: str,
+        collect_metrics: bool = False,
+        deck_key: str | None = None,
+    ) -> str:
+        """Queue the build of a deck and return the job id."""
+        self._expire()
+        job_id = uuid.uuid4().hex
+        directory = os.path.join(self.root, job_id)
+        os.mkdir(directory)
+        future = self._executor.submit(
+            run_build_job, directory, cards, language, mode, collect_metrics, deck_key
+        )
+        with self._lock:
+            self._jobs[job_id] = Job(job_id, directory, mode, future)
+        return job_id
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def remove(self, job_id: str):
+        """Cancel a job if it has not started and delete its files."""
+        with self._lock:
+            job = self._jobs.pop(job_id, None)
+        if job is not None:
+            job.future.cancel()
+            if job.future.done():
+                shutil.rmtree(job.directory, ignore_errors=True)
+            else:
+                # Still running, deleted once the worker is done with it
+                job.future.add_done_callback(
+                    lambda _: shutil.rmtree(job.directory, ignore_errors=True)
+                )
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            expired = [job.id for job in self._jobs.values() if job.created < cutoff]
+        for job_id in expired:
+            self.remove(job_id)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_job_queue() -> JobQueue:
+    """Return the process-wide job queue, shared by all Streamlit sessions."""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            workers = os.environ.get("LCG_JOB_WORKERS")
+            _queue = JobQueue(int(workers) if workers else None)
+        return _queue
@@ -1,269 +1,335 @@
-from io import BytesIO
 import streamlit as st
-import genanki
-from gtts import gTTS
-from PIL import Image
-import requests
-from bs4 import BeautifulSoup
+from deck_builder import DeckBuilder, audio_requests
+from deck_store import get_deck_store
+from metrics import Metrics
+from parsing import ParseReport, iter_cards, iter_cards_from_file
+from images import get_image_urls, load_images, prefetch_image_urls
+from jobs import get_job_queue
+from tts import SpeechPrefetcher
 from st_clickable_images import clickable_images
+import io
 import os
+import shutil
+import tempfile
+import uuid
+import weakref
+
+# Number of upcoming cards whose image searches run in the background
+IMAGE_PREFETCH_CARDS = 3
+# Number of upcoming cards whose audio is synthesized in the background
+TTS_PREFETCH_CARDS = 3
+
+
+def create_note(fields):
+    """Add the current card to the session's deck."""
+    builder = st.session_state.builder
+    prefetcher = st.session_state.speech_prefetcher
+    # Only blocks on the clips that the prefetcher has not finished yet
+    clips = []
+    failed = []
+    with st.session_state.metrics.stage("tts_wait"):
+        for request in audio_requests(fields, builder.language, builder.mode):
+            if request is None or builder.sound_filename(request) in builder.media:
+                clips.append(None)  # Nothing to synthesize, or already in the deck
+                continue
+            try:
+                clips.append(prefetcher.get(request))
+            except Exception as e:
+                # Like add_cards: the card is added, without this sound
+                clips.append(None)
+                failed.append((request, e))
+    builder.add_card(fields, clips=clips, images=st.session_state.image_data)
+    builder.failed_audio.extend(failed)
+    st.session_state.setdefault("failed_audio", []).extend(
+        (request.text, str(error)) for request, error in failed
+    )
+    st.session_state.card_audio_errors = failed
 
+    # Reset image-related session state for lexicon mode
+    st.session_state.image_data = []
+    st.session_state.image_urls_to_add = []
 
-# Parser function
-def create_list_of_cards(src_text: str, mode: str = "lexicon") -> list[dict]:
-    """
-    Creates a list of dictionaries corresponding to fields from a given text.
 
-    Args:
-        src_text (str): The text to parse
-        mode (str): The mode - "lexicon", "pronunciation", or "grammar"
+class SessionFile:
+    """
+    Temporary file owned by one session.
 
-    Returns:
-        list[dict]: A list of dictionaries representing cards based on the mode
+    The file is deleted by ``cleanup`` or, at the latest, when the object is
+    garbage collected together with the session state of a closed session.
     """
-    list_of_cards = []
-
-    if mode == "lexicon":
-        # Original lexicon mode
-        header = ["baseT", "baseS", "fullT", "s1T", "s1S", "s2T", "s2S"]
-        lines = src_text.strip().splitlines()
-        for line in lines:
-            if line.strip():  # Check if the line is not empty
-                parts = line.split("|")
-                record = {
-                    header[i]: parts[i].strip() if i < len(parts) else ""
-                    for i in range(len(header))
-                }
-                list_of_cards.append(record)
-
-    elif mode == "pronunciation":
-        # Pronunciation mode - each line is a word/sentence
-        lines = src_text.strip().splitlines()
-        for line in lines:
-            if line.strip():
-                record = {"word": line.strip()}
-                list_of_cards.append(record)
-
-    elif mode == "grammar":
-        # Grammar mode - fields separated by " | "
-        lines = src_text.strip().splitlines()
-        for line in lines:
-            if line.strip():
-                parts = line.strip().split(" | ")
-                if len(parts) >= 2:
-                    record = {
-                        "Front": parts[0].strip(),
-                        "Back": parts[1].strip(),
-                        "Rule": parts[2].strip() if len(parts) > 2 else "",
-                    }
-                    list_of_cards.append(record)
-
-    return list_of_cards
-
-
-def color_gender(field, selected_language):
-    if selected_language == "de":
-        if field.startswith("die "):
-            field = f'<span style="color: rgb(255, 88, 111);">{field}</span>'
-        elif field.startswith("das "):
-            field = f'<span style="color: rgb(88, 255, 101);">{field}</span>'
-        elif field.startswith("der "):
-            field = f'<span style="color: rgb(88, 141, 255);">{field}</span>'
-    return field
-
-
-def create_note(fields, selected_language, mode="lexicon"):
-    """Create an Anki note based on the mode."""
-
-    # Common CSS style
-    css = """.card{
-    font-family: arial;
-    font-size: 20px;
-    text-align: center;
-    color: black;
-    background-color: white;
-    }"""
-
-    model_card_generator = None
-
-    if mode == "lexicon":
-        # Original lexicon model
-        model_card_generator = genanki.Model(
-            1284830180,
-            "Language (and reversed card) card generator",
-            fields=[
-                {"name": "baseS"},
-                {"name": "baseT"},
-                {"name": "AbaseT"},
-                {"name": "fullT"},
-                {"name": "AfullT"},
-                {"name": "s1T"},
-                {"name": "As1T"},
-                {"name": "s2T"},
-                {"name": "As2T"},
-                {"name": "image1"},
-                {"name": "image2"},
-            ],
-            templates=[
-                {
-                    "name": "Card 1",
-                    "qfmt": "{{baseS}}<br>{{image1}} {{image2}}",
-                    "afmt": "{{baseS}}<br>{{image1}} {{image2}} <br> {{fullT}} {{AfullT}}"
-                    '<hr id="answer">{{s1T}} {{As1T}}<br> {{s2T}} {{As2T}}',
-                },
-                {
-                    "name": "Card 2",
-                    "qfmt": "{{baseT}} {{AbaseT}}",
-                    "afmt": "{{fullT}} {{AfullT}}<br>{{baseS}}"
-                    '<hr id="answer">{{image1}} {{image2}}<br> {{s1T}}{{As1T}}<br> {{s2T}} {{As2T}}',
-                },
-            ],
-            css=css,
-        )
 
-        fields_note = [fields["baseS"]]
-        # generate audio
-        for i, key in enumerate(["baseT", "fullT", "s1T", "s2T"]):
-            if fields[key] == "":
-                fields_note.extend([fields[key], ""])
-                continue
-            sound = gTTS(text=fields[key], lang=selected_language, slow=False)
-            sound.save(f"sound{st.session_state.index}_{i}.mp3")
-            st.session_state.all_media.append(f"sound{st.session_state.index}_{i}.mp3")
-            if key == "fullT":
-                fields["fullT"] = color_gender(fields["fullT"], selected_language)
-            fields_note.extend(
-                [fields[key], f"[sound:sound{st.session_state.index}_{i}.mp3]"]
-            )
+    def __init__(self, suffix=""):
+        fd, self.path = tempfile.mkstemp(prefix="lcg_", suffix=suffix)
+        os.close(fd)
+        self._finalizer = weakref.finalize(self, _remove_file, self.path)
 
-        # Add images dynamically
-        images = [
-            f'<img src="{img_name}">' for img_name in st.session_state.image_filename
-        ]
-        while len(images) < 2:  # Ensure 2 image placeholders
-            images.append("")
-        fields_note.extend(images)  # Add images to the fields
-
-        # Extend the all media file
-        for img_name in st.session_state.image_filename:
-            st.session_state.all_media.append(img_name)
-
-    elif mode == "pronunciation":
-        # Pronunciation model (from AusspracheDeutsch.py)
-        model_card_generator = genanki.Model(
-            1081735104,
-            "Simple Model with Media",
-            fields=[
-                {"name": "Question"},
-                {"name": "MyMedia"},
-            ],
-            templates=[
-                {
-                    "name": "Card 1",
-                    "qfmt": "{{Question}}",
-                    "afmt": '{{FrontSide}}<hr id="answer">{{MyMedia}}',
-                },
-            ],
-            css=css,
+    def read_bytes(self) -> bytes:
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def cleanup(self):
+        self._finalizer()
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def create_deck():
+    builder = st.session_state.builder
+
+    # Write the package straight to a per-session file, so the session only
+    # holds its path and the bytes are read back when the download is clicked
+    for key in ("apkg_file", "delta_file"):
+        if key in st.session_state:
+            st.session_state.pop(key).cleanup()
+    st.session_state.apkg_file = SessionFile(suffix=".apkg")
+    builder.write_to_file(st.session_state.apkg_file.path)
+    st.session_state.file_name = builder.file_name
+    st.session_state.apkg_deck = builder.deck_key
+    st.session_state.apkg_version = builder.version
+
+    # Cards added since the deck was last downloaded, to import alone
+    since = builder.last_checkpoint
+    if since is not None and builder.notes_since(since):
+        st.session_state.delta_file = SessionFile(suffix=".apkg")
+        builder.write_to_file(st.session_state.delta_file.path, since=since)
+        st.session_state.delta_file_name = builder.delta_file_name
+
+
+def record_download():
+    """Record the deck as exported at the version of the package downloaded."""
+    deck_key = st.session_state.apkg_deck
+    version = st.session_state.apkg_version
+    builder = st.session_state.get("builder")
+    if builder is not None and builder.deck_key == deck_key:
+        builder.checkpoint(version)
+        return
+    store = get_deck_store()
+    if store.checkpoints(deck_key)[-1:] != [version]:
+        store.add_checkpoint(deck_key, version)
+
+
+@st.fragment
+def image_picker():
+    """Image grid of the lexicon review; a click only reruns this fragment."""
+    if "clicked" not in st.session_state:  # Ensure `clicked` is only computed once
+        st.session_state.image_clicked = clickable_images(
+            st.session_state.image_viewer_urls,
+            div_style={
+                "display": "flex",
+                "justify-content": "center",
+                "flex-wrap": "wrap",
+                "gap": "2px",  # Space between images
+                "padding": "1px",
+            },
+            img_style={
+                "margin": "5px",
+                "max-width": "none",
+                "max-height": "none",
+                "width": "auto",
+                "height": "auto",
+                "object-fit": "contain",
+            },
+            key="image_viewer",
         )
 
-        word = fields["word"]
-        sound = gTTS(text=word, tld="com", lang=selected_language, slow=False)
-        sound.save(f"sound_{word}_{st.session_state.index}.mp3")
-        st.session_state.all_media.append(f"sound_{word}_{st.session_state.index}.mp3")
-
-        fields_note = [word, f"[sound:sound_{word}_{st.session_state.index}.mp3]"]
-
-    elif mode == "grammar":
-        # Grammar model (unified model that handles both with/without rules)
-        model_card_generator = genanki.Model(
-            1091735125,
-            "Simple Model with Media",
-            fields=[
-                {"name": "Question"},
-                {"name": "Answer"},
-                {"name": "MyMedia"},
-                {"name": "explanation"},
-            ],
-            templates=[
-                {
-                    "name": "Card 1",
-                    "qfmt": "{{Question}}",
-                    "afmt": '{{FrontSide}}<hr id="answer">{{Answer}}<br>{{MyMedia}}<br>{{explanation}}',
-                },
-            ],
-            css=css,
+    if st.session_state.image_clicked > -1:
+        st.subheader("Selected images")
+        st.session_state.image_urls_to_add.append(
+            st.session_state.image_viewer_urls[st.session_state.image_clicked]
         )
+        st.session_state.image_urls_to_add = st.session_state.image_urls_to_add[-2:]
+        st.image(st.session_state.image_urls_to_add)
 
-        sound = gTTS(text=fields["Back"], lang=selected_language, slow=False)
-        sound.save(f"sound_grammar_{st.session_state.index}.mp3")
-        st.session_state.all_media.append(f"sound_grammar_{st.session_state.index}.mp3")
 
-        fields_note = [
-            fields["Front"],
-            fields["Back"],
-            f"[sound:sound_grammar_{st.session_state.index}.mp3]",
-            fields.get("Rule", ""),  # Empty string if no rule
-        ]
+def save_review():
+    """Save the cards and position of the review, to resume it from the URL."""
+    get_deck_store().save_session(
+        st.session_state.deck_key,
+        st.session_state.cards,
+        st.session_state.current_card,
+    )
 
-    # Create the note
-    note = genanki.Note(model=model_card_generator, fields=fields_note)
-    st.session_state.deck.add_note(note)  # Modify deck in session_state
-    st.session_state.index += 1
 
-    # Reset image-related session state for lexicon mode
-    if mode == "lexicon":
-        st.session_state.image_filename = []
-        st.session_state.image_urls_to_add = []
+def move_to_card(step):
+    new_card = st.session_state.current_card + step
+    if 0 <= new_card < len(st.session_state.cards):
+        st.session_state.current_card = new_card
+    save_review()
 
 
-def create_deck():
-    # Create the Anki package
-    package = genanki.Package(st.session_state.deck)
-    package.media_files = st.session_state.all_media
-
-    # Write package to in-memory buffer instead of file
-    output = BytesIO()
-    package.write_to_file(
-        output
-    )  # This works because genanki supports file-like objects
-
-    # Move the cursor to the beginning of the buffer
-    output.seek(0)
-
-    # Save in session state for later use (e.g., download)
-    st.session_state.apkg_data = output.read()
-    st.session_state.file_name = f"{st.session_state.deck.name}.apkg"
-
-
-def get_image_urls(keyword: str, subdomain: str) -> list[str]:
-    # Starting from a keyword, creates a list of URLs which direct to images.
-
-    # Create a Google Images URL for the search term
-    search_url = f"https://www.google.{subdomain}/search?q={keyword}&tbm=isch"
-    # Send an HTTP GET request to the URL
-    response = requests.get(search_url, timeout=10)
-    # Parse the HTML content of the page
-    soup = BeautifulSoup(response.text, "html.parser")
-    # Find image links in the page source
-    list_of_tags = soup.find_all("img")
-    list_of_urls = []
-    for tag in list_of_tags:
-        list_of_urls.append(tag.get("src"))
-    # On google image, first one is google logo
-    list_of_urls.pop(0)
-    return list_of_urls
-
-
-def load_images(urls):
-    """Download and return images from URLs."""
-    images = []
-    for url in urls:
-        response = requests.get(url, timeout=10)
-        if response.status_code == 200:
-            img = Image.open(BytesIO(response.content))
-            images.append(img)
-    return images
+def add_current_card():
+    create_note(st.session_state.cards[st.session_state.current_card])
+    move_to_card(1)
+
+
+@st.fragment
+def review_card():
+    """Navigation and actions of the lexicon review; reruns only this pane."""
+    # Lexicon mode UI
+    col1, col2, col3, col4, col5 = st.columns(5)
+
+    # Navigation runs in callbacks, before the fragment is rendered again
+    col1.button("Previous", on_click=move_to_card, args=(-1,))
+    col3.button("Next", on_click=move_to_card, args=(1,))
+    col5.button("Add Card", on_click=add_current_card)
+
+    current_card = st.session_state.current_card
+    fields = st.session_state.cards[current_card]
+
+    with col2:
+        st.write(f"Card {current_card + 1}/{len(st.session_state.cards)}")
+
+    failed = st.session_state.pop("card_audio_errors", [])
+    if failed:
+        st.warning(
+            "The card was added without sound for "
+            + ", ".join(f"{request.text!r} ({error})" for request, error in failed)
+        )
+
+    # Warm the image search cache for the next few cards
+    prefetch_image_urls(
+        [
+            card["baseT"]
+            for card in st.session_state.cards[
+                current_card : current_card + IMAGE_PREFETCH_CARDS + 1
+            ]
+        ],
+        st.session_state.selected_language,
+    )
+
+    if col4.button("Image"):
+        try:
+            with st.session_state.metrics.stage("image_search", items=1):
+                st.session_state.image_viewer_urls = get_image_urls(
+                    fields["baseT"], st.session_state.selected_language
+                )
+        except Exception as e:
+            st.warning(f"Image search failed, try again later: {e}")
+        else:
+            st.rerun()  # Switching to the image picker needs a full rerun
+
+    edit_fields(current_card)
+
+
+@st.fragment
+def edit_fields(card_index):
+    """Editable fields of a lexicon card; an edit only reruns this fragment."""
+    fields = st.session_state.cards[card_index]
+
+    # Show editable fields for lexicon cards
+    for key, value in fields.items():
+        new_value = st.text_input(f"{key}", value=value)
+        fields[key] = new_value
+
+    # Synthesize the audio of this and the next cards in the
+    # background, dropping clips of edited fields or passed cards
+    builder = st.session_state.builder
+    upcoming = [
+        request
+        for card in st.session_state.cards[
+            card_index : card_index + TTS_PREFETCH_CARDS + 1
+        ]
+        for request in audio_requests(
+            card, st.session_state.selected_language, "lexicon"
+        )
+        # Clips the deck already holds are not needed
+        if request is not None and builder.sound_filename(request) not in builder.media
+    ]
+    st.session_state.speech_prefetcher.retain(upcoming)
+    st.session_state.speech_prefetcher.prefetch(upcoming)
+
+
+def metrics_panel():
+    """Optional sidebar with the per-stage timings of this session's builds."""
+    enabled = st.sidebar.toggle("Build metrics", key="metrics_enabled")
+    if "metrics" in st.session_state:
+        st.session_state.metrics.enabled = enabled
+    if not enabled:
+        return
+
+    stats = st.session_state.metrics.to_dict()
+    if not stats:
+        st.sidebar.caption("No stage recorded yet.")
+        return
+    st.sidebar.dataframe(
+        [
+            {
+                "stage": name,
+                "runs": stage["count"],
+                "seconds": stage["total_seconds"],
+                "items": stage["items"],
+                "KiB": round(stage["bytes"] / 1024, 1),
+                "errors": stage["errors"],
+            }
+            for name, stage in stats.items()
+        ],
+        hide_index=True,
+    )
+    st.sidebar.download_button(
+        "Export JSON",
+        data=st.session_state.metrics.to_json,
+        file_name="metrics.json",
+        mime="application/json",
+        on_click="ignore",
+    )
+    st.sidebar.download_button(
+        "Export Prometheus",
+        data=st.session_state.metrics.to_prometheus,
+        file_name="metrics.prom",
+        mime="text/plain",
+        on_click="ignore",
+    )
+
+
+@st.fragment(run_every=1)
+def job_progress():
+    """Poll the background build of this session's deck until it ends."""
+    queue = get_job_queue()
+    job = queue.get(st.session_state.job_id)
+    if job is None:
+        status = {"state": "failed", "error": "the job no longer exists"}
+    else:
+        status = job.status()
+    if status["state"] in ("queued", "running"):
+        total = status["total"]
+        st.progress(
+            status["done"] / total if total else 0.0,
+            text=(
+                f"Building the deck: {status['done']}/{total} clips"
+                if status["state"] == "running"
+                else "Waiting for a free worker..."
+            ),
+        )
+        return
+
+    if status["state"] == "done":
+        # The package moves into this session, like one built in the script
+        for key in ("apkg_file", "delta_file"):
+            if key in st.session_state:
+                st.session_state.pop(key).cleanup()
+        st.session_state.apkg_file = SessionFile(suffix=".apkg")
+        shutil.move(job.result_path, st.session_state.apkg_file.path)
+        st.session_state.file_name = status["file_name"]
+        if status["delta_file_name"]:
+            st.session_state.delta_file = SessionFile(suffix=".apkg")
+            shutil.move(job.delta_path, st.session_state.delta_file.path)
+            st.session_state.delta_file_name = status["delta_file_name"]
+        st.session_state.apkg_deck = status["deck_key"]
+        st.session_state.apkg_version = status["version"]
+        st.session_state.build_reports = status["reports"]
+        st.session_state.failed_audio = status["failed_audio"]
+        st.session_state.metrics.merge(status["metrics"])
+    else:
+        st.session_state.job_error = status["error"]
+    queue.remove(st.session_state.job_id)
+    del st.session_state.job_id
+    st.query_params.pop("job", None)
+    st.rerun()
 
 
 def reset_app():
@@ -273,14 +339,18 @@ def reset_app():
 def main():
     if st.session_state.get("reset"):
         # Clean local files
-        files_to_delete = st.session_state.all_media + [st.session_state.file_name]
-
-        for path in files_to_delete:
-            if os.path.exists(path):
-                try:
-                    os.remove(path)
-                except OSError as e:
-                    st.warning(f"Could not delete {path}: {e}")
+        if "builder" in st.session_state:
+            st.session_state.builder.close()
+        for key in ("apkg_file", "delta_file"):
+            if key in st.session_state:
+                st.session_state[key].cleanup()
+        if "speech_prefetcher" in st.session_state:
+            st.session_state.speech_prefetcher.close()
+        if "job_id" in st.session_state:
+            get_job_queue().remove(st.session_state.job_id)
+        if "deck_key" in st.session_state:
+            get_deck_store().discard_session(st.session_state.deck_key)
+        st.query_params.clear()
 
         # Clean session states
         for key in list(st.session_state.keys()):
@@ -289,23 +359,51 @@ def main():
         st.rerun()
 
     st.set_page_config(page_title="Anki Card Generator")
-    # Initialize deck and all_media in session_state (if not already initialized)
+    # Initialize session_state (if not already initialized)
     if "card_mode" not in st.session_state:
         st.session_state.card_mode = "lexicon"
     if "cards" not in st.session_state:
         st.session_state.cards = []
         st.session_state.current_card = 0
         st.session_state.submitted = False  # Track submission state
-    if "all_media" not in st.session_state:
-        st.session_state.all_media = []  # Store media lis
-    if "index" not in st.session_state:  # index to go up for each added card?
-        st.session_state.index = 0
     if "image_urls_to_add" not in st.session_state:
         st.session_state.image_urls_to_add = []
-    if "image_filename" not in st.session_state:
-        st.session_state.image_filename = []
+    if "image_data" not in st.session_state:
+        st.session_state.image_data = []  # Encoded images for the current card
     if "image_viewer_urls" not in st.session_state:
         st.session_state.image_viewer_urls = []
+    if "metrics" not in st.session_state:
+        st.session_state.metrics = Metrics(enabled=False)
+    if "speech_prefetcher" not in st.session_state:
+        st.session_state.speech_prefetcher = SpeechPrefetcher()
+    if "deck_key" not in st.session_state and "deck" in st.query_params:
+        # A reloaded tab, or a bookmark, reopens its deck and resumes its review
+        deck_key = st.query_params["deck"]
+        deck = get_deck_store().deck(deck_key)
+        session = get_deck_store().load_session(deck_key)
+        if deck is not None:
+            st.session_state.deck_key = deck_key
+        if deck is not None and session is not None:
+            st.session_state.cards, st.session_state.current_card = session
+            st.session_state.selected_language = deck["language"]
+            st.session_state.card_mode = deck["mode"]
+            st.session_state.submitted = True
+            st.session_state.builder = DeckBuilder(
+                deck["language"],
+                deck["mode"],
+                metrics=st.session_state.metrics,
+                store=get_deck_store(),
+                deck_key=deck_key,
+            )
+    if "job_id" not in st.session_state and "job" in st.query_params:
+        # A reloaded tab picks up the build it had started
+        job = get_job_queue().get(st.query_params["job"])
+        if job is not None:
+            st.session_state.job_id = job.id
+            st.session_state.card_mode = job.mode
+            st.session_state.submitted = True
+
+    metrics_panel()
 
     if not st.session_state.submitted:
         # Define language options
@@ -345,57 +443,86 @@ def main():
             text_area_help = "Format: Question | Answer | Rule (rule is optional)"
 
         user_input = st.text_area(text_area_label, help=text_area_help)
+        uploaded_file = st.file_uploader(
+            "...or upload a file (text, CSV, TSV or JSONL)",
+            type=["txt", "csv", "tsv", "jsonl"],
+            help="CSV/TSV columns and JSONL keys follow the same field order",
+        )
 
         if st.button("Submit"):
-            if user_input:
-                st.session_state.cards = create_list_of_cards(user_input, selected_mode)
+            if user_input or uploaded_file:
+                report = ParseReport()
+                if uploaded_file is not None:
+                    cards = iter_cards_from_file(
+                        uploaded_file, selected_mode, report=report
+                    )
+                else:
+                    cards = iter_cards(
+                        io.StringIO(user_input), selected_mode, report=report
+                    )
+                with st.session_state.metrics.stage("parse"):
+                    st.session_state.cards = list(cards)
+                st.session_state.metrics.add_items("parse", report.accepted)
+                st.session_state.parse_report = report
                 st.session_state.current_card = 0
                 st.session_state.submitted = True  # Hide inputs after submission
-                if (
-                    "deck" not in st.session_state
-                    and "selected_language" in st.session_state
+
+                # Cards are added to the deck of the URL, if it is of the same kind
+                deck = get_deck_store().deck(st.session_state.get("deck_key", ""))
+                if deck is None or (deck["language"], deck["mode"]) != (
+                    selected_language,
+                    selected_mode,
                 ):
-                    # Different deck info based on mode
-                    if selected_mode == "lexicon":
-                        deck_info = {
-                            "de": (87654321, "Deutsch"),
-                            "es": (87654322, "Espanol"),
-                            "fr": (87654323, "Francais"),
-                        }
-                    elif selected_mode == "pronunciation":
-                        deck_info = {
-                            "de": (100234568, "DeutschAussprache"),
-                            "es": (100234569, "EspanolPronunciacion"),
-                            "fr": (100234570, "FrancaisPrononciation"),
-                        }
-                    else:  # grammar
-                        deck_info = {
-                            "de": (1234567, "Grammar_Deutsch"),
-                            "es": (1234568, "Grammar_Espanol"),
-                            "fr": (1234569, "Grammar_Francais"),
-                        }
-
-                    lang = st.session_state.selected_language
-                    deck_id, deck_name = deck_info.get(
-                        lang, list(deck_info.values())[0]
+                    st.session_state.deck_key = uuid.uuid4().hex
+                st.query_params["deck"] = st.session_state.deck_key
+
+                if selected_mode == "lexicon" and "builder" not in st.session_state:
+                    st.session_state.builder = DeckBuilder(
+                        st.session_state.selected_language,
+                        selected_mode,
+                        metrics=st.session_state.metrics,
+                        store=get_deck_store(),
+                        deck_key=st.session_state.deck_key,
                     )
-                    st.session_state.deck = genanki.Deck(deck_id, deck_name)
+                    save_review()
 
-                # For pronunciation and grammar modes, process all cards automatically
+                # Pronunciation and grammar decks are built by a worker process,
+                # so the build survives reruns and a disconnected tab
                 if selected_mode in ["pronunciation", "grammar"]:
-                    progress_bar = st.progress(0)
-                    st.info(f"Processing {len(st.session_state.cards)} cards...")
-
-                    for i, card in enumerate(st.session_state.cards):
-                        create_note(card, selected_language, selected_mode)
-                        progress_bar.progress((i + 1) / len(st.session_state.cards))
-
-                    create_deck()
-                    st.success("All cards processed successfully!")
-                    progress_bar.empty()
+                    st.session_state.job_id = get_job_queue().submit(
+                        st.session_state.cards,
+                        st.session_state.selected_language,
+                        selected_mode,
+                        collect_metrics=st.session_state.metrics.enabled,
+                        deck_key=st.session_state.deck_key,
+                    )
+                    st.query_params["job"] = st.session_state.job_id
             st.rerun()
 
     else:
+        report = st.session_state.get("parse_report")
+        if report is not None and (report.rejected_count or report.warning_count):
+            with st.expander(report.summary(), expanded=not report.ok):
+                st.text("\n".join(report.lines()))
+
+        if "job_id" in st.session_state:
+            job_progress()
+        if "job_error" in st.session_state:
+            st.error(f"Building the deck failed: {st.session_state.job_error}")
+            if st.button("Start over"):
+                reset_app()
+                st.rerun()
+
+        for report_line in st.session_state.get("build_reports", []):
+            st.caption(report_line)
+        failed_audio = st.session_state.get("failed_audio", [])
+        if failed_audio:
+            with st.expander(
+                f"{len(failed_audio)} clips could not be synthesized, "
+                "their cards were added without sound"
+            ):
+                st.text("\n".join(f"{text!r}: {error}" for text, error in failed_audio))
+
         # Check if we're in lexicon mode for the full card review interface
         if st.session_state.card_mode == "lexicon":
             # Lexicon mode - full interface with image support and card review
@@ -414,109 +541,64 @@ def main():
 
                 with col_add:
                     if st.button("Add images"):
-                        images_to_save = load_images(st.session_state.image_urls_to_add)
-                        st.session_state.image_filename = []
-                        for i, image in enumerate(images_to_save):
-                            st.session_state.image_filename.append(
-                                f"image{st.session_state.index}_{i}.png"
+                        metrics = st.session_state.metrics
+                        with metrics.stage("image_download"):
+                            images_to_save, failed = load_images(
+                                st.session_state.image_urls_to_add
                             )
-                            image.save(f"image{st.session_state.index}_{i}.png")
+                        metrics.add_items("image_download", len(images_to_save))
+                        metrics.add_bytes(
+                            "image_download", sum(len(data) for data in images_to_save)
+                        )
+                        for _ in failed:
+                            metrics.error("image_download")
+                        # Shown after the rerun below
+                        st.session_state.image_load_errors = failed
+                        st.session_state.image_data = images_to_save
                         st.success("Images saved successfully!")
                         st.session_state.image_viewer_urls = []
                         del st.session_state["image_clicked"]
                         st.rerun()
 
-                if (
-                    "clicked" not in st.session_state
-                ):  # Ensure `clicked` is only computed once
-                    st.session_state.image_clicked = clickable_images(
-                        st.session_state.image_viewer_urls,
-                        div_style={
-                            "display": "flex",
-                            "justify-content": "center",
-                            "flex-wrap": "wrap",
-                            "gap": "2px",  # Space between images
-                            "padding": "1px",
-                        },
-                        img_style={
-                            "margin": "5px",
-                            "max-width": "none",
-                            "max-height": "none",
-                            "width": "auto",
-                            "height": "auto",
-                            "object-fit": "contain",
-                        },
-                        key="image_viewer",
-                    )
-
-                if st.session_state.image_clicked > -1:
-                    st.subheader("Selected images")
-                    st.session_state.image_urls_to_add.append(
-                        st.session_state.image_viewer_urls[
-                            st.session_state.image_clicked
-                        ]
-                    )
-                    st.session_state.image_urls_to_add = (
-                        st.session_state.image_urls_to_add[-2:]
-                    )
-                    st.image(st.session_state.image_urls_to_add)
+                image_picker()
 
             if st.session_state.cards and not (
                 show_image_interface and st.session_state.image_viewer_urls
             ):
-                current_card = st.session_state.current_card
-                fields = st.session_state.cards[current_card]
-
-                # Lexicon mode UI
-                col1, col2, col3, col4, col5 = st.columns(5)
-
-                if col1.button("Previous") and current_card > 0:
-                    st.session_state.current_card -= 1
-
-                if (
-                    col3.button("Next")
-                    and current_card < len(st.session_state.cards) - 1
-                ):
-                    st.session_state.current_card += 1
+                for url, reason in st.session_state.pop("image_load_errors", []):
+                    st.warning(f"Could not load image {url}: {reason}")
 
-                current_card = st.session_state.current_card
-                fields = st.session_state.cards[current_card]
-
-                with col2:
-                    st.write(f"Card {current_card + 1}/{len(st.session_state.cards)}")
-
-                if col4.button("Image"):
-                    st.session_state.image_viewer_urls = get_image_urls(
-                        fields["baseT"], st.session_state.selected_language
-                    )
-                    st.rerun()
-
-                if col5.button("Add Card"):
-                    create_note(
-                        fields,
-                        st.session_state.selected_language,
-                        st.session_state.card_mode,
-                    )
-                    if current_card < len(st.session_state.cards) - 1:
-                        st.session_state.current_card += 1
-                    st.rerun()
-
-                # Show editable fields for lexicon cards
-                for key, value in fields.items():
-                    new_value = st.text_input(f"{key}", value=value)
-                    fields[key] = new_value
+                review_card()
 
                 if st.button("Add Deck"):
                     create_deck()
+                    st.caption(st.session_state.builder.dedup_report())
+                    st.caption(st.session_state.builder.image_report())
+                    if st.session_state.builder.audio_options.enabled:
+                        st.caption(st.session_state.builder.audio_report())
 
         # For all modes: show download button if deck is ready
-        if "apkg_data" in st.session_state:
+        if "apkg_file" in st.session_state:
             st.download_button(
                 label="Download Anki Deck",
-                data=st.session_state.apkg_data,
+                data=st.session_state.apkg_file.read_bytes,
                 file_name=st.session_state.file_name,
                 mime="application/octet-stream",
-                on_click="ignore",
+                on_click=record_download,
+            )
+            if "delta_file" in st.session_state:
+                st.download_button(
+                    label="Download new cards only",
+                    data=st.session_state.delta_file.read_bytes,
+                    file_name=st.session_state.delta_file_name,
+                    mime="application/octet-stream",
+                    on_click=record_download,
+                    help="The cards added since this deck was last downloaded, "
+                    "to import into Anki without the cards it already has",
+                )
+            st.caption(
+                "Bookmark this page to add more cards to this deck later; "
+                "Reset starts a new deck."
             )
             if st.button("Reset"):
                 reset_app()
@@ -0,0 +1,144 @@
+import itertools
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import weakref
+import zipfile
+
+import genanki
+
+
+def _default_spill_threshold() -> int:
+    return int(float(os.environ.get("LCG_MEDIA_SPILL_MB", "32")) * 1024 * 1024)
+
+
+class MediaStore:
+    """
+    Media files of one deck, kept in memory up to a size threshold.
+
+    Once the in-memory bytes would go above ``spill_threshold``, further files
+    are written to a private temporary directory instead. The directory is
+    removed by ``close`` or when the store is garbage collected.
+    """
+
+    def __init__(self, spill_threshold: int | None = None):
+        if spill_threshold is None:
+            spill_threshold = _default_spill_threshold()
+        self.spill_threshold = spill_threshold
+        self.memory_bytes = 0
+        self._memory = {}  # Filename -> bytes
+        self._spilled = {}  # Filename -> path on disk
+        self._sizes = {}  # Filename -> size, in insertion order
+        self._lock = threading.Lock()
+        self._dir = None
+        self._finalizer = None
+
+    def __contains__(self, filename: str) -> bool:
+        return filename in self._sizes
+
+    def __len__(self) -> int:
+        return len(self._sizes)
+
+    def __iter__(self):
+        return iter(list(self._sizes))
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(self._sizes.values())
+
+    def size(self, filename: str) -> int:
+        return self._sizes[filename]
+
+    def add(self, filename: str, data: bytes) -> bool:
+        """Store ``data`` under ``filename``; return False if it was already there."""
+        with self._lock:
+            if filename in self._sizes:
+                return False
+            if self.memory_bytes + len(data) <= self.spill_threshold:
+                self._memory[filename] = data
+                self.memory_bytes += len(data)
+            else:
+                path = os.path.join(self._spill_dir(), filename)
+                with open(path, "wb") as f:
+                    f.write(data)
+                self._spilled[filename] = path
+            self._sizes[filename] = len(data)
+            return True
+
+    def read(self, filename: str) -> bytes:
+        if filename in self._memory:
+            return self._memory[filename]
+        with open(self._spilled[filename], "rb") as f:
+            return f.read()
+
+    def write_to_zip(self, outzip: zipfile.ZipFile, filename: str, arcname: str):
+        """Copy a media file into an open zip archive without an extra copy."""
+        if filename in self._memory:
+            outzip.writestr(arcname, self._memory[filename])
+        else:
+            outzip.write(self._spilled[filename], arcname)
+
+    def _spill_dir(self) -> str:
+        if self._dir is None:
+            self._dir = tempfile.mkdtemp(prefix="lcg_media_")
+            self._finalizer = weakref.finalize(
+                self, shutil.rmtree, self._dir, ignore_errors=True
+            )
+        return self._dir
+
+    def close(self):
+        """Drop all media and remove the spill directory."""
+        with self._lock:
+            self._memory.clear()
+            self._spilled.clear()
+            self._sizes.clear()
+            self.memory_bytes = 0
+            if self._finalizer is not None:
+                self._finalizer()
+            self._dir = None
+            self._finalizer = None
+
+
+class StorePackage(genanki.Package):
+    """
+    A genanki package whose media files are read from a MediaStore.
+
+    ``media_files`` restricts the package to some of the files of the store.
+    """
+
+    def __init__(self, deck_or_decks, media_store: MediaStore, media_files=None):
+        super().__init__(deck_or_decks)
+        self.media_store = media_store
+        self.media_files = media_files
+
+    def write_to_file(self, file, timestamp: float | None = None):
+        # Same layout as genanki.Package.write_to_file, with media from the store
+        fd, dbfilename = tempfile.mkstemp(suffix=".anki2")
+        os.close(fd)
+        try:
+            conn = sqlite3.connect(dbfilename)
+            cursor = conn.cursor()
+            if timestamp is None:
+                timestamp = time.time()
+            id_gen = itertools.count(int(timestamp * 1000))
+            self.write_to_db(cursor, timestamp, id_gen)
+            conn.commit()
+            conn.close()
+
+            with zipfile.ZipFile(file, "w") as outzip:
+                outzip.write(dbfilename, "collection.anki2")
+
+                filenames = list(
+                    self.media_store if self.media_files is None else self.media_files
+                )
+                media_json = dict(enumerate(filenames))
+                outzip.writestr("media", json.dumps(media_json))
+
+                for idx, filename in enumerate(filenames):
+                    self.media_store.write_to_zip(outzip, filename, str(idx))
+        finally:
+            os.remove(dbfilename)
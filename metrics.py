@@ -0,0 +1,173 @@
+import bisect
+import json
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_NULL_CONTEXT = nullcontext()
+
+
+class StageStats:
+    """Latency histogram and counters of one pipeline stage."""
+
+    __slots__ = ("bucket_counts", "count", "total_seconds", "items", "bytes", "errors")
+
+    def __init__(self):
+        self.bucket_counts = [0] * (len(BUCKETS) + 1)  # Last one is +Inf
+        self.count = 0
+        self.total_seconds = 0.0
+        self.items = 0
+        self.bytes = 0
+        self.errors = 0
+
+    def observe(self, seconds: float):
+        self.bucket_counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total_seconds += seconds
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "total_seconds": round(self.total_seconds, 6),
+            "mean_seconds": (
+                round(self.total_seconds / self.count, 6) if self.count else None
+            ),
+            "buckets": dict(
+                zip([str(b) for b in BUCKETS] + ["+Inf"], self.bucket_counts)
+            ),
+            "items": self.items,
+            "bytes": self.bytes,
+            "errors": self.errors,
+        }
+
+
+class Metrics:
+    """
+    Per-session timings and counters of the deck build stages.
+
+    When ``enabled`` is False every method returns immediately, and ``stage``
+    hands out a shared no-op context manager, so instrumented code costs next
+    to nothing.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def _get(self, stage: str) -> StageStats:
+        stats = self._stages.get(stage)
+        if stats is None:
+            stats = self._stages.setdefault(stage, StageStats())
+        return stats
+
+    def stage(self, name: str, items: int = 0):
+        """Context manager timing one run of a stage and counting its errors."""
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return self._timed(name, items)
+
+    @contextmanager
+    def _timed(self, name: str, items: int):
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.error(name)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start, items)
+
+    def observe(self, stage: str, seconds: float, items: int = 0):
+        if not self.enabled:
+            return
+        with self._lock:
+            stats = self._get(stage)
+            stats.observe(seconds)
+            stats.items += items
+
+    def add_items(self, stage: str, items: int = 1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._get(stage).items += items
+
+    def add_bytes(self, stage: str, n: int):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._get(stage).bytes += n
+
+    def error(self, stage: str):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._get(stage).errors += 1
+
+    def merge(self, stats: dict):
+        """Add the stages of another collector, as returned by its to_dict."""
+        if not self.enabled:
+            return
+        with self._lock:
+            for name, other in stats.items():
+                mine = self._get(name)
+                for i, count in enumerate(other["buckets"].values()):
+                    mine.bucket_counts[i] += count
+                mine.count += other["count"]
+                mine.total_seconds += other["total_seconds"]
+                mine.items += other["items"]
+                mine.bytes += other["bytes"]
+                mine.errors += other["errors"]
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {name: stats.to_dict() for name, stats in self._stages.items()}
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self, prefix: str = "lcg") -> str:
+        """Render the metrics in the Prometheus text exposition format."""
+        with self._lock:
+            stages = list(self._stages.items())
+        lines = [
+            f"# HELP {prefix}_stage_seconds Latency of deck build stages.",
+            f"# TYPE {prefix}_stage_seconds histogram",
+        ]
+        for name, stats in stages:
+            cumulative = 0
+            for bound, count in zip(list(BUCKETS) + ["+Inf"], stats.bucket_counts):
+                cumulative += count
+                lines.append(
+                    f'{prefix}_stage_seconds_bucket{{stage="{name}",le="{bound}"}} '
+                    f"{cumulative}"
+                )
+            lines.append(
+                f'{prefix}_stage_seconds_sum{{stage="{name}"}} {stats.total_seconds}'
+            )
+            lines.append(
+                f'{prefix}_stage_seconds_count{{stage="{name}"}} {stats.count}'
+            )
+        for metric, attribute, help_text in [
+            ("items_total", "items", "Items processed per stage."),
+            ("bytes_total", "bytes", "Bytes produced per stage."),
+            ("errors_total", "errors", "Errors raised per stage."),
+        ]:
+            lines.append(f"# HELP {prefix}_{metric} {help_text}")
+            lines.append(f"# TYPE {prefix}_{metric} counter")
+            for name, stats in stages:
+                lines.append(
+                    f'{prefix}_{metric}{{stage="{name}"}} {getattr(stats, attribute)}'
+                )
+        return "\n".join(lines) + "\n"
+
+
+# Shared default for code paths that are not instrumented
+NULL_METRICS = Metrics(enabled=False)
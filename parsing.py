@@ -0,0 +1,290 @@
+import csv
+import io
+import json
+import os
+from dataclasses import dataclass
+from typing import IO, Iterable, Iterator
+
+
+class CardRecord:
+    """
+    Base class of the parsed cards.
+
+    Records are slotted dataclasses, much smaller than one dict per line, but
+    they can still be read and edited like the dicts used before:
+    ``card["baseT"]``, ``card.get("Rule", "")`` and ``card.items()`` all work.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def header(cls) -> tuple[str, ...]:
+        return cls.__match_args__  # The field names, set by @dataclass
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        if key not in self.header():
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return self.header()
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.__match_args__]
+
+    def to_dict(self) -> dict:
+        return dict(self.items())
+
+
+@dataclass(slots=True)
+class LexiconCard(CardRecord):
+    baseT: str = ""
+    baseS: str = ""
+    fullT: str = ""
+    s1T: str = ""
+    s1S: str = ""
+    s2T: str = ""
+    s2S: str = ""
+
+
+@dataclass(slots=True)
+class PronunciationCard(CardRecord):
+    word: str = ""
+
+
+@dataclass(slots=True)
+class GrammarCard(CardRecord):
+    Front: str = ""
+    Back: str = ""
+    Rule: str = ""
+
+
+RECORD_TYPES = {
+    "lexicon": LexiconCard,
+    "pronunciation": PronunciationCard,
+    "grammar": GrammarCard,
+}
+
+# Fields a card cannot do without, per mode
+REQUIRED_FIELDS = {
+    "lexicon": ["baseT"],
+    "pronunciation": ["word"],
+    "grammar": ["Front", "Back"],
+}
+
+FORMATS = ["text", "csv", "tsv", "jsonl"]
+
+
+class ParseReport:
+    """
+    Line-numbered account of the rows that were rejected or accepted with a
+    warning (missing or extra fields).
+
+    Only the first ``max_issues`` problems are kept in memory; the counters
+    always cover the whole input.
+    """
+
+    def __init__(self, max_issues: int = 1000):
+        self.max_issues = max_issues
+        self.accepted = 0
+        self.rejected_count = 0
+        self.warning_count = 0
+        self.rejected = []  # (line number, reason, line)
+        self.warnings = []  # (line number, reason, line)
+
+    def reject(self, line_no: int, reason: str, line: str):
+        self.rejected_count += 1
+        if len(self.rejected) < self.max_issues:
+            self.rejected.append((line_no, reason, line))
+
+    def warn(self, line_no: int, reason: str, line: str):
+        self.warning_count += 1
+        if len(self.warnings) < self.max_issues:
+            self.warnings.append((line_no, reason, line))
+
+    @property
+    def ok(self) -> bool:
+        return self.rejected_count == 0
+
+    def summary(self) -> str:
+        return (
+            f"{self.accepted} cards accepted, {self.rejected_count} rows rejected, "
+            f"{self.warning_count} rows with warnings"
+        )
+
+    def lines(self) -> Iterator[str]:
+        """Human readable description of every recorded problem, in line order."""
+        issues = [
+            (line_no, f"rejected, {reason}", line)
+            for line_no, reason, line in self.rejected
+        ]
+        issues += self.warnings
+        for line_no, reason, line in sorted(issues, key=lambda issue: issue[0]):
+            yield f"line {line_no}: {reason}: {line!r}"
+
+
+def _split_text_line(line: str, mode: str) -> list[str]:
+    if mode == "lexicon":
+        return line.split("|")
+    elif mode == "pronunciation":
+        return [line]
+    # Grammar mode - fields separated by " | "
+    return line.strip().split(" | ")
+
+
+def _rows(lines: Iterable[str], mode: str, fmt: str) -> Iterator[tuple]:
+    """Yield (line number, raw line, parts or dict) for each non-empty row."""
+    if fmt == "text":
+        for line_no, line in enumerate(lines, start=1):
+            line = line.rstrip("\r\n")
+            if line.strip():  # Check if the line is not empty
+                yield line_no, line, _split_text_line(line, mode)
+
+    elif fmt in ("csv", "tsv"):
+        # The reader takes the physical lines of one row at a time, so the raw
+        # text of the row, quotes included, is what it took since the last one
+        consumed = []
+
+        def tracked():
+            for line in lines:
+                consumed.append(line)
+                yield line
+
+        reader = csv.reader(tracked(), delimiter="," if fmt == "csv" else "\t")
+        header = RECORD_TYPES[mode].header()
+        for row in reader:
+            raw = "".join(consumed).rstrip("\r\n")
+            consumed.clear()
+            line_no = reader.line_num
+            if not any(cell.strip() for cell in row):
+                continue
+            if line_no == 1 and tuple(c.strip() for c in row) == header[: len(row)]:
+                continue  # Header row
+            yield line_no, raw, row
+
+    elif fmt == "jsonl":
+        for line_no, line in enumerate(lines, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                obj = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield line_no, line, e
+                continue
+            yield line_no, line, obj
+
+    else:
+        raise ValueError(f"Unknown format {fmt!r}, expected one of {FORMATS}")
+
+
+def iter_cards(
+    lines: Iterable[str],
+    mode: str = "lexicon",
+    fmt: str = "text",
+    report: ParseReport | None = None,
+) -> Iterator[CardRecord]:
+    """
+    Lazily parse cards from lines of text.
+
+    Args:
+        lines (Iterable[str]): The input, e.g. an open file
+        mode (str): The mode - "lexicon", "pronunciation", or "grammar"
+        fmt (str): The format - "text" ('|' delimited), "csv", "tsv" or "jsonl"
+        report (ParseReport): Collects the rejected and incomplete rows
+
+    Yields:
+        CardRecord: One record per accepted row
+    """
+    record_type = RECORD_TYPES[mode]
+    header = record_type.header()
+    required = REQUIRED_FIELDS[mode]
+    if report is None:
+        report = ParseReport()
+
+    for line_no, line, row in _rows(lines, mode, fmt):
+        if isinstance(row, Exception):
+            report.reject(line_no, f"invalid JSON ({row.msg})", line)
+            continue
+        if isinstance(row, dict):
+            if not set(row) & set(header):
+                report.reject(line_no, f"expected fields {list(header)}", line)
+                continue
+            raw = {key: row.get(key) for key in header}
+            provided = sum(key in row for key in header)
+        elif isinstance(row, list):
+            raw = {
+                key: row[i] if i < len(row) else None for i, key in enumerate(header)
+            }
+            provided = len(row)
+        else:
+            report.reject(line_no, f"expected fields {list(header)}", line)
+            continue
+
+        # JSON can hold numbers, lists, ... where text is expected; null is empty
+        not_text = [
+            key
+            for key, value in raw.items()
+            if value is not None and not isinstance(value, str)
+        ]
+        if not_text:
+            report.reject(line_no, f"not text: {', '.join(not_text)}", line)
+            continue
+        values = {key: (value or "").strip() for key, value in raw.items()}
+
+        missing = [key for key in required if not values[key]]
+        if missing:
+            report.reject(line_no, f"missing {', '.join(missing)}", line)
+            continue
+        if provided < len(header) and mode == "lexicon":
+            report.warn(
+                line_no, f"{provided} of {len(header)} fields, rest left empty", line
+            )
+        elif provided > len(header):
+            report.warn(
+                line_no, f"{provided} fields, only the first {len(header)} used", line
+            )
+
+        report.accepted += 1
+        yield record_type(**values)
+
+
+def detect_format(path: str) -> str:
+    """Guess the input format from a file extension."""
+    extension = os.path.splitext(path)[1].lower().lstrip(".")
+    return {"csv": "csv", "tsv": "tsv", "jsonl": "jsonl", "ndjson": "jsonl"}.get(
+        extension, "text"
+    )
+
+
+def iter_cards_from_file(
+    file: str | IO[bytes],
+    mode: str = "lexicon",
+    fmt: str | None = None,
+    report: ParseReport | None = None,
+) -> Iterator[CardRecord]:
+    """
+    Lazily parse cards from a path or a binary file object, e.g. an upload.
+
+    The format is detected from the file name when ``fmt`` is None.
+    """
+    name = file if isinstance(file, str) else getattr(file, "name", "")
+    fmt = fmt or detect_format(name)
+    if isinstance(file, str):
+        with open(file, encoding="utf-8-sig", newline="") as f:
+            yield from iter_cards(f, mode, fmt, report)
+    else:
+        text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+        try:
+            yield from iter_cards(text, mode, fmt, report)
+        finally:
+            text.detach()  # Leave the underlying file open for its owner
@@ -0,0 +1,281 @@
+import multiprocessing
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing.managers import BaseManager, BaseProxy
+
+import requests
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling a service that keeps failing."""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name} is unavailable, retrying in {retry_after:.0f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+    def __reduce__(self):
+        # Raised across processes by shared limiters
+        return CircuitOpenError, (self.name, self.retry_after)
+
+
+def _response(error: Exception):
+    # requests.HTTPError has .response, gTTSError has .rsp. Error responses are
+    # falsy, so they are compared with None explicitly.
+    response = getattr(error, "response", None)
+    return response if response is not None else getattr(error, "rsp", None)
+
+
+def _status_code(error: Exception) -> int | None:
+    return getattr(_response(error), "status_code", None)
+
+
+def is_transient(error: Exception) -> bool:
+    """Whether ``error`` means the service is overloaded rather than the call wrong."""
+    status = _status_code(error)
+    if status is not None:
+        return status == 429 or status >= 500
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    # gTTS reports connection failures as a gTTSError without a response
+    return type(error).__name__ == "gTTSError" and getattr(error, "rsp", 1) is None
+
+
+def _retry_after(error: Exception) -> float | None:
+    try:
+        return float(_response(error).headers["Retry-After"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    """
+    Token bucket limiting the calls made to one service by the whole process.
+
+    The rate adapts to the service: every transient failure (429, 5xx or a
+    connection error) halves it and pauses all callers for an exponentially
+    growing delay, and every success raises it again by a small step up to
+    ``max_rate``. After ``failure_threshold`` consecutive transient failures
+    the circuit opens: calls fail at once with CircuitOpenError for
+    ``cooldown`` seconds, after which a single trial call is let through.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_rate: float,
+        burst: int = 1,
+        min_rate: float | None = None,
+        failure_threshold: int = 5,
+        cooldown: float = 60.0,
+        max_backoff: float = 30.0,
+    ):
+        self.name = name
+        self.max_rate = max_rate
+        self.min_rate = min_rate or max_rate / 16
+        self.rate = max_rate
+        self.burst = burst
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_backoff = max_backoff
+        self.consecutive_failures = 0
+        self.throttled = 0  # Transient failures seen, for reporting
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._open_until = 0.0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """Wait for a token, or raise CircuitOpenError if the circuit is open."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if self.consecutive_failures >= self.failure_threshold:
+                    if now < self._open_until or self._trial_running:
+                        raise CircuitOpenError(
+                            self.name, max(self._open_until - now, 1.0)
+                        )
+                    self._trial_running = True  # Half open
+                    return
+                self._refill(now)
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def try_acquire(self) -> bool:
+        """Take a token only if one is available right away."""
+        with self._lock:
+            now = time.monotonic()
+            if self.consecutive_failures >= self.failure_threshold:
+                return False
+            self._refill(now)
+            if now >= self._paused_until and self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self._trial_running = False
+            # Additive increase: back to full speed after ~20 calls
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def failure(self, retry_after: float | None = None):
+        with self._lock:
+            self.throttled += 1
+            self.consecutive_failures += 1
+            self._trial_running = False
+            self.rate = max(self.min_rate, self.rate / 2)
+            backoff = min(self.max_backoff, 2**self.consecutive_failures / 4)
+            backoff = retry_after or backoff * random.uniform(0.5, 1.0)
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + backoff)
+            if self.consecutive_failures >= self.failure_threshold:
+                self._open_until = now + self.cooldown
+
+    @contextmanager
+    def limit(self, acquire: bool = True):
+        """
+        Context manager wrapping one call to the service.
+
+        ``acquire`` is False when the token was already taken by try_acquire.
+        """
+        if acquire:
+            self.acquire()
+        try:
+            yield
+        except Exception as e:
+            if is_transient(e):
+                self.failure(_retry_after(e))
+            else:
+                self.success()  # The service answered, the call was at fault
+            raise
+        self.success()
+
+    def backing_off(self) -> bool:
+        """Whether calls are currently paused after failures, or the circuit open."""
+        with self._lock:
+            return (
+                time.monotonic() < self._paused_until
+                or self.consecutive_failures >= self.failure_threshold
+            )
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "rate": round(self.rate, 3),
+                "throttled": self.throttled,
+                "circuit_open": self.consecutive_failures >= self.failure_threshold,
+            }
+
+
+class RateLimiterProxy(BaseProxy):
+    """A RateLimiter held by the limiter server of share_limiters."""
+
+    _exposed_ = (
+        "acquire",
+        "try_acquire",
+        "success",
+        "failure",
+        "backing_off",
+        "stats",
+    )
+
+    def acquire(self):
+        return self._callmethod("acquire")
+
+    def try_acquire(self) -> bool:
+        return self._callmethod("try_acquire")
+
+    def success(self):
+        return self._callmethod("success")
+
+    def failure(self, retry_after: float | None = None):
+        return self._callmethod("failure", (retry_after,))
+
+    def backing_off(self) -> bool:
+        return self._callmethod("backing_off")
+
+    def stats(self) -> dict:
+        return self._callmethod("stats")
+
+    limit = RateLimiter.limit
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+_server = None  # Manager of the limiters shared with other processes
+
+# Requests per second allowed by default, overridden by LCG_<NAME>_RATE
+DEFAULT_RATES = {"gtts": 8.0, "google": 2.0}
+
+
+def get_limiter(name: str) -> RateLimiter:
+    """
+    Return the process-wide limiter of a service, shared by all sessions.
+
+    The maximum rate in requests per second is read from LCG_<NAME>_RATE, e.g.
+    LCG_GTTS_RATE or LCG_GOOGLE_RATE. After share_limiters or connect_limiters
+    the limiter is held by a server process, and shared with other processes.
+    """
+    with _limiters_lock:
+        if name not in _limiters:
+            if _server is not None:
+                _limiters[name] = _server.limiter(name)
+            else:
+                rate = float(
+                    os.environ.get(
+                        f"LCG_{name.upper()}_RATE", DEFAULT_RATES.get(name, 4.0)
+                    )
+                )
+                _limiters[name] = RateLimiter(name, rate, burst=max(1, int(rate)))
+        return _limiters[name]
+
+
+class _LimiterManager(BaseManager):
+    pass
+
+
+# Runs in the server process, where get_limiter returns local limiters
+_LimiterManager.register("limiter", get_limiter, proxytype=RateLimiterProxy)
+
+
+def share_limiters() -> tuple:
+    """
+    Move the limiters of this process to a server process, so that other
+    processes (e.g. job workers) can share them with connect_limiters.
+
+    Returns:
+        tuple: The (address, authkey) to pass to connect_limiters
+    """
+    global _server
+    with _limiters_lock:
+        if _server is None:
+            server = _LimiterManager(ctx=multiprocessing.get_context("spawn"))
+            server.start()
+            _server = server
+            # Limiters created before are dropped, with their current state
+            _limiters.clear()
+        return _server.address, bytes(_server._authkey)
+
+
+def connect_limiters(address, authkey: bytes):
+    """Use the limiters shared by another process with share_limiters."""
+    global _server
+    server = _LimiterManager(address, authkey)
+    server.connect()
+    with _limiters_lock:
+        _server = server
+        _limiters.clear()
@@ -0,0 +1,640 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from io import BytesIO
+from typing import Callable, Iterator, NamedTuple
+
+from gtts import gTTS
+
+from audio import ffmpeg_available, split_on_silences
+from metrics import NULL_METRICS, Metrics
+from ratelimit import CircuitOpenError, get_limiter
+
+
+class SpeechRequest(NamedTuple):
+    """A single utterance to synthesize."""
+
+    text: str
+    lang: str
+    tld: str = "com"
+    slow: bool = False
+
+    def key(self) -> str:
+        """Content hash identifying the audio produced for this request."""
+        raw = "\x1f".join([self.text, self.lang, self.tld, str(int(self.slow))])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class AudioCache:
+    """
+    Content-addressed on-disk cache of synthesized clips.
+
+    Entries are stored as ``<key>.mp3`` in a single directory, so every process
+    pointing at the same directory shares them. Writes go through a temporary
+    file followed by ``os.replace`` and are therefore atomic. The modification
+    time of an entry is refreshed on every hit and used as the LRU order when
+    the total size goes above ``max_bytes``.
+
+    The total size is scanned once and then kept up to date by ``put``, so the
+    directory is only scanned again when the limit is crossed. Eviction then
+    goes down to ``low_water`` of the limit, which keeps such scans rare.
+    Other processes' writes are only seen at the next scan.
+    """
+
+    low_water = 0.9
+
+    def __init__(self, directory: str, max_bytes: int = 512 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._size = sum(size for _, size, _ in self._entries())
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.mp3")
+
+    def get(self, key: str) -> bytes | None:
+        """Return the cached clip for ``key`` or None."""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # Mark as recently used
+        except OSError:
+            # Missing, or evicted by another session between open and utime
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes):
+        """Atomically store ``data`` under ``key`` and evict if over the limit."""
+        path = self._path(key)
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with self._lock:
+            self._size += len(data) - replaced
+            over = self._size > self.max_bytes
+        if over:
+            self.evict()
+
+    def _entries(self) -> list[tuple[float, int, str]]:
+        # (mtime, size, path) of every entry
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith(".mp3"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in max_bytes."""
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            target = self.max_bytes * self.low_water
+            entries.sort()  # Oldest first
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue  # Already removed by a concurrent session
+                total -= size
+                with self._lock:
+                    self.evictions += 1
+        with self._lock:
+            self._size = total
+
+    def stats(self) -> dict:
+        """Return hit/miss/eviction counters for this process."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_audio_cache() -> AudioCache | None:
+    """
+    Return the process-wide audio cache, configured from the environment.
+
+    LCG_AUDIO_CACHE_DIR sets the cache directory and LCG_AUDIO_CACHE_MAX_MB its
+    size limit. Setting LCG_AUDIO_CACHE_MAX_MB to 0 disables the cache.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            max_mb = float(os.environ.get("LCG_AUDIO_CACHE_MAX_MB", "512"))
+            if max_mb <= 0:
+                return None
+            directory = os.environ.get(
+                "LCG_AUDIO_CACHE_DIR",
+                os.path.join(
+                    os.path.expanduser("~"), ".cache", "languagecardsgenerator", "tts"
+                ),
+            )
+            _cache = AudioCache(directory, int(max_mb * 1024 * 1024))
+        return _cache
+
+
+def _gtts_bytes(request: SpeechRequest) -> bytes:
+    sound = gTTS(
+        text=request.text, tld=request.tld, lang=request.lang, slow=request.slow
+    )
+    buffer = BytesIO()
+    # All sessions share one limiter, so concurrent builds slow down together
+    with get_limiter("gtts").limit():
+        sound.write_to_fp(buffer)
+    return buffer.getvalue()
+
+
+class TTSBackend:
+    """
+    A speech synthesis engine.
+
+    Subclasses implement ``synthesize_batch`` (or ``synthesize`` when they can
+    only produce one clip per call), and ``synthesize_parts`` when the clips of
+    a batch are ready in several parts. ``batch_size`` is the number of
+    requests handed to one ``synthesize_batch`` call and ``max_workers`` the
+    default number of calls run concurrently.
+    """
+
+    name = ""
+    extension = "mp3"
+    batch_size = 1
+    max_workers = 8
+
+    def cache_key(self, request: SpeechRequest) -> str:
+        """Hash identifying the clip this backend produces for ``request``."""
+        raw = "\x1f".join([self.name, self.voice(request), request.key()])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def media_filename(self, request: SpeechRequest) -> str:
+        """Content-addressed media filename for the clip of ``request``."""
+        return f"sound_{self.cache_key(request)[:16]}.{self.extension}"
+
+    def voice(self, request: SpeechRequest) -> str:
+        """The voice used for ``request``, part of the cache key."""
+        return request.lang
+
+    def synthesize(self, request: SpeechRequest) -> bytes:
+        return self.synthesize_batch([request])[0]
+
+    def synthesize_batch(self, requests: list[SpeechRequest]) -> list[bytes]:
+        return [self.synthesize(request) for request in requests]
+
+    def synthesize_parts(
+        self, requests: list[SpeechRequest]
+    ) -> Iterator[tuple[list[int], list[bytes]]]:
+        """
+        Synthesize ``requests``, yielding (indices, clips) as parts are ready,
+        so that the clips of a batch failing midway are not all lost.
+        """
+        yield list(range(len(requests))), self.synthesize_batch(requests)
+
+
+# Said between joined utterances, so that they are separated by a pause
+JOIN_SEPARATOR = ". "
+# Text with its own pauses would not split back into one clip per utterance
+PAUSE_PUNCTUATION = re.compile(r"[.,;:!?…]")
+
+
+class GTTSBackend(TTSBackend):
+    """
+    Google Translate's text-to-speech, over the network.
+
+    With ``join`` (enabled by LCG_TTS_JOIN=1, needs ffmpeg), short utterances
+    are joined with pauses into as few gTTS calls as possible, and the speech
+    returned is split back into one clip per utterance at the pauses. A group
+    whose joined call fails, or whose pauses do not match its utterances, is
+    synthesized one by one instead.
+    """
+
+    name = "gtts"
+
+    def __init__(self, join: bool | None = None):
+        if join is None:
+            join = os.environ.get("LCG_TTS_JOIN", "0").lower() in ("1", "true", "yes")
+        if join and not ffmpeg_available():
+            raise RuntimeError("Joining speech needs ffmpeg, which was not found")
+        self.join = join
+        if self.join:
+            self.batch_size = 32
+        self.joined_calls = 0  # gTTS calls made for several utterances
+        self.join_fallbacks = 0  # Of which had to be synthesized one by one
+        self._lock = threading.Lock()
+
+    def cache_key(self, request: SpeechRequest) -> str:
+        return request.key()  # Unchanged, so existing caches stay valid
+
+    def synthesize(self, request: SpeechRequest) -> bytes:
+        return _gtts_bytes(request)
+
+    def join_report(self) -> str:
+        return (
+            f"Joined speech: {self.joined_calls} gTTS calls for several clips, "
+            f"{self.join_fallbacks} synthesized one by one instead"
+        )
+
+    def _join_groups(self, requests: list[SpeechRequest]) -> list[list[int]]:
+        # gTTS makes one call per 100 characters, so a group stays below that
+        groups = []
+        open_groups = {}  # (lang, tld, slow) -> (indices, length) being filled
+        for i, request in enumerate(requests):
+            text = request.text.strip()
+            if PAUSE_PUNCTUATION.search(text):
+                groups.append([i])
+                continue
+            voice = (request.lang, request.tld, request.slow)
+            indices, length = open_groups.get(voice, ([], 0))
+            length += len(text) + (len(JOIN_SEPARATOR) if indices else 0)
+            if indices and length > gTTS.GOOGLE_TTS_MAX_CHARS:
+                groups.append(indices)
+                indices, length = [], len(text)
+            indices.append(i)
+            open_groups[voice] = (indices, length)
+        groups.extend(indices for indices, _ in open_groups.values())
+        return groups
+
+    def synthesize_batch(self, requests: list[SpeechRequest]) -> list[bytes]:
+        if not self.join:
+            return super().synthesize_batch(requests)
+        clips = [b""] * len(requests)
+        for indices, parts in self.synthesize_parts(requests):
+            for i, data in zip(indices, parts):
+                clips[i] = data
+        return clips
+
+    def synthesize_parts(
+        self, requests: list[SpeechRequest]
+    ) -> Iterator[tuple[list[int], list[bytes]]]:
+        if not self.join:
+            yield from super().synthesize_parts(requests)
+            return
+        for indices in self._join_groups(requests):
+            group = [requests[i] for i in indices]
+            parts = None
+            if len(group) > 1:
+                first = group[0]
+                joined = first._replace(
+                    text=JOIN_SEPARATOR.join(request.text.strip() for request in group)
+                )
+                try:
+                    parts = split_on_silences(_gtts_bytes(joined), len(group))
+                except Exception:
+                    parts = None  # Errors of the single calls below surface instead
+                with self._lock:
+                    self.joined_calls += 1
+                    self.join_fallbacks += parts is None
+            if parts is None:
+                parts = [self.synthesize(request) for request in group]
+            yield indices, parts
+
+
+class EspeakBackend(TTSBackend):
+    """
+    Offline synthesis with espeak-ng, one subprocess per clip.
+
+    Clips are WAV files. The voice is the request language, ``tld`` is ignored.
+    """
+
+    name = "espeak"
+    extension = "wav"
+    max_workers = os.cpu_count() or 4
+
+    def __init__(self, executable: str | None = None):
+        self.executable = executable or os.environ.get("LCG_ESPEAK", "espeak-ng")
+
+    def synthesize(self, request: SpeechRequest) -> bytes:
+        speed = "110" if request.slow else "160"  # Words per minute
+        result = subprocess.run(
+            [self.executable, "-v", request.lang, "-s", speed, "--stdout"],
+            input=request.text.encode("utf-8"),
+            capture_output=True,
+            check=True,
+        )
+        return result.stdout
+
+
+class PiperBackend(TTSBackend):
+    """
+    Offline neural synthesis with piper, many clips per subprocess.
+
+    The voice model of a language is read from LCG_PIPER_MODEL_<LANG> (e.g.
+    LCG_PIPER_MODEL_DE), falling back to LCG_PIPER_MODEL. Clips are WAV files.
+    """
+
+    name = "piper"
+    extension = "wav"
+    batch_size = 64
+    max_workers = os.cpu_count() or 4
+
+    def __init__(self, executable: str | None = None):
+        self.executable = executable or os.environ.get("LCG_PIPER", "piper")
+
+    def voice(self, request: SpeechRequest) -> str:
+        model = os.environ.get(
+            f"LCG_PIPER_MODEL_{request.lang.upper()}",
+            os.environ.get("LCG_PIPER_MODEL"),
+        )
+        if not model:
+            raise RuntimeError(
+                f"No piper voice for {request.lang!r}, "
+                f"set LCG_PIPER_MODEL_{request.lang.upper()}"
+            )
+        return model
+
+    def synthesize_batch(self, requests: list[SpeechRequest]) -> list[bytes]:
+        # One piper run per voice and speed, each reading JSON lines on stdin
+        groups = {}
+        for i, request in enumerate(requests):
+            groups.setdefault((self.voice(request), request.slow), []).append(i)
+
+        clips = [b""] * len(requests)
+        with tempfile.TemporaryDirectory(prefix="lcg_piper_") as directory:
+            for (model, slow), indices in groups.items():
+                lines = [
+                    json.dumps(
+                        {
+                            "text": requests[i].text,
+                            "output_file": os.path.join(directory, f"{i}.wav"),
+                        }
+                    )
+                    for i in indices
+                ]
+                subprocess.run(
+                    [
+                        self.executable,
+                        "--model",
+                        model,
+                        "--json-input",
+                        "--length_scale",
+                        "1.4" if slow else "1.0",
+                    ],
+                    input="\n".join(lines).encode("utf-8"),
+                    capture_output=True,
+                    check=True,
+                )
+                for i in indices:
+                    with open(os.path.join(directory, f"{i}.wav"), "rb") as f:
+                        clips[i] = f.read()
+        return clips
+
+
+BACKENDS = {
+    "gtts": GTTSBackend,
+    "espeak": EspeakBackend,
+    "piper": PiperBackend,
+}
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(name: str | None = None) -> TTSBackend:
+    """
+    Return the process-wide instance of a TTS backend.
+
+    The default backend is read from LCG_TTS_BACKEND ("gtts", "espeak" or
+    "piper") and is gTTS when unset.
+    """
+    name = name or os.environ.get("LCG_TTS_BACKEND", "gtts")
+    if name not in BACKENDS:
+        raise ValueError(
+            f"Unknown TTS backend {name!r}, expected one of {list(BACKENDS)}"
+        )
+    with _backends_lock:
+        if name not in _backends:
+            backend = BACKENDS[name]()
+            if name != "gtts" and shutil.which(backend.executable) is None:
+                raise RuntimeError(
+                    f"{backend.executable} not found for TTS backend {name!r}"
+                )
+            _backends[name] = backend
+        return _backends[name]
+
+
+def synthesize_batch(
+    requests: list[SpeechRequest], backend: TTSBackend | None = None
+) -> list[bytes]:
+    """Return the clips for ``requests``, going through the audio cache."""
+    backend = backend or get_backend()
+    cache = get_audio_cache()
+    if cache is None:
+        return backend.synthesize_batch(requests)
+
+    keys = [backend.cache_key(request) for request in requests]
+    clips = [cache.get(key) for key in keys]
+    missing = [i for i, clip in enumerate(clips) if clip is None]
+    if missing:
+        # Cached part by part, so a retry of a batch failing midway skips the rest
+        parts = backend.synthesize_parts([requests[i] for i in missing])
+        for indices, fresh in parts:
+            for j, data in zip(indices, fresh):
+                cache.put(keys[missing[j]], data)
+                clips[missing[j]] = data
+    return clips
+
+
+def synthesize(request: SpeechRequest, backend: TTSBackend | None = None) -> bytes:
+    """Return the clip for ``request``, going through the audio cache."""
+    return synthesize_batch([request], backend)[0]
+
+
+def _synthesize_with_retries(
+    requests: list[SpeechRequest],
+    retries: int,
+    metrics: Metrics = NULL_METRICS,
+    backend: TTSBackend | None = None,
+) -> list[bytes]:
+    for attempt in range(retries + 1):
+        try:
+            with metrics.stage("tts_request", items=len(requests)):
+                clips = synthesize_batch(requests, backend)
+            metrics.add_bytes("tts_request", sum(len(clip) for clip in clips))
+            return clips
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(0.5 * 2**attempt)
+
+
+def _synthesize_attempt(
+    requests: tuple[SpeechRequest, ...],
+    delay: float,
+    metrics: Metrics,
+    backend: TTSBackend,
+) -> list[bytes]:
+    time.sleep(delay)
+    with metrics.stage("tts_request", items=len(requests)):
+        clips = synthesize_batch(list(requests), backend)
+    metrics.add_bytes("tts_request", sum(len(clip) for clip in clips))
+    return clips
+
+
+def synthesize_many(
+    requests: list[SpeechRequest],
+    max_workers: int | None = None,
+    retries: int = 3,
+    on_progress: Callable[[int, int], None] | None = None,
+    metrics: Metrics = NULL_METRICS,
+    backend: TTSBackend | None = None,
+    failed: list | None = None,
+) -> list[bytes | None]:
+    """
+    Synthesize several requests concurrently.
+
+    A failing backend call goes back at the end of the queue and is retried
+    after a delay, so the other requests keep going meanwhile.
+
+    Args:
+        requests (list[SpeechRequest]): The utterances to synthesize
+        max_workers (int): Maximum number of backend calls in flight at once,
+            the backend's default when None
+        retries (int): How many times a failing call is retried
+        on_progress (Callable): Called as on_progress(done, total) from the
+            calling thread each time distinct requests finish
+        metrics (Metrics): Records the latency of every backend call
+        backend (TTSBackend): The engine to use, get_backend() when None
+        failed (list): If given, requests still failing after all retries are
+            appended to it as (request, error) pairs and get None as clip.
+            Otherwise the first such error is raised.
+
+    Returns:
+        list[bytes | None]: The clips, in the same order as ``requests``
+    """
+    backend = backend or get_backend()
+    # Repeated utterances are synthesized only once
+    unique = list(dict.fromkeys(requests))
+    clips = {}
+    if not unique:
+        return []
+
+    batches = [
+        tuple(unique[i : i + backend.batch_size])
+        for i in range(0, len(unique), backend.batch_size)
+    ]
+    attempts = dict.fromkeys(batches, 0)
+    done = 0
+    with ThreadPoolExecutor(max_workers=max_workers or backend.max_workers) as executor:
+        pending = {
+            executor.submit(_synthesize_attempt, batch, 0, metrics, backend): batch
+            for batch in batches
+        }
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                batch = pending.pop(future)
+                try:
+                    clips.update(zip(batch, future.result()))
+                except Exception as e:
+                    attempts[batch] += 1
+                    if attempts[batch] <= retries:
+                        # Requeue; throttling itself is waited out by the limiter
+                        if isinstance(e, CircuitOpenError):
+                            delay = e.retry_after
+                        else:
+                            delay = 0.5 * 2 ** (attempts[batch] - 1)
+                        retry = executor.submit(
+                            _synthesize_attempt, batch, delay, metrics, backend
+                        )
+                        pending[retry] = batch
+                        continue
+                    if failed is None:
+                        for other in pending:
+                            other.cancel()
+                        raise
+                    failed.extend((request, e) for request in batch)
+                    clips.update(dict.fromkeys(batch))
+                done += len(batch)
+                if on_progress is not None:
+                    on_progress(done, len(unique))
+    return [clips[request] for request in requests]
+
+
+# Shared by the speech prefetchers of all sessions
+_speculative_executor = ThreadPoolExecutor(
+    max_workers=8, thread_name_prefix="tts-prefetch"
+)
+
+
+class SpeechPrefetcher:
+    """
+    Synthesizes clips in the background before they are needed.
+
+    Each request is keyed by its full content, so when a field is edited its
+    new text is simply a different request; ``retain`` drops (and cancels, if
+    not started yet) the clips that are no longer wanted.
+    """
+
+    def __init__(self):
+        self._futures = {}  # SpeechRequest -> Future
+        self._lock = threading.Lock()
+
+    def prefetch(self, requests: list[SpeechRequest]):
+        """Start synthesizing the requests that are not already scheduled."""
+        with self._lock:
+            for request in requests:
+                if request is not None and request not in self._futures:
+                    self._futures[request] = _speculative_executor.submit(
+                        _synthesize_with_retries, [request], 2
+                    )
+
+    def retain(self, requests: list[SpeechRequest]):
+        """Forget every scheduled request that is not in ``requests``."""
+        wanted = set(requests)
+        with self._lock:
+            for request in list(self._futures):
+                if request not in wanted:
+                    self._futures.pop(request).cancel()
+
+    def get(self, request: SpeechRequest) -> bytes:
+        """Return the clip for ``request``, waiting for it only if not ready yet."""
+        with self._lock:
+            future = self._futures.pop(request, None)
+        if future is not None and not future.cancelled():
+            try:
+                return future.result()[0]
+            except Exception:
+                pass  # Retried below in the foreground, so errors surface here
+        return synthesize(request)
+
+    def close(self):
+        self.retain([])